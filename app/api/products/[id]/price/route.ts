@@ -31,6 +31,27 @@ export async function GET(
       );
     }
 
+    // Precomputed by the catalog migration (product_prices): one query instead of two
+    const { data: precomputed } = await supabase
+      .from('product_prices')
+      .select('monthly_price, total_price, coefficient, selling_price')
+      .eq('product_id', params.id)
+      .eq('leaser_id', product.default_leaser_id)
+      .eq('months', durationMonths)
+      .maybeSingle();
+
+    if (precomputed) {
+      return NextResponse.json({
+        success: true,
+        price: {
+          monthlyPrice: parseFloat(precomputed.monthly_price.toString()),
+          totalPrice: parseFloat(precomputed.total_price.toString()),
+          coefficient: parseFloat(precomputed.coefficient.toString()),
+          sellingPrice: parseFloat(precomputed.selling_price.toString()),
+        },
+      });
+    }
+
     const purchasePrice = parseFloat(product.purchase_price_ht.toString());
     const marginPercent = parseFloat(product.marlon_margin_percent.toString());
     const sellingPrice = purchasePrice * (1 + marginPercent / 100);
@@ -48,14 +69,18 @@ export async function GET(
       );
     }
 
+    // Same rule as the precomputed prices: no max_amount means no ceiling, and
+    // when tranches overlap the highest one (largest min_amount) wins
     const { data: coeffData } = await supabase
       .from('leaser_coefficients')
       .select('coefficient')
       .eq('leaser_id', product.default_leaser_id)
       .eq('duration_id', duration.id)
-      .gte('max_amount', sellingPrice)
       .lte('min_amount', sellingPrice)
-      .single();
+      .or(`max_amount.is.null,max_amount.gte.${sellingPrice}`)
+      .order('min_amount', { ascending: false })
+      .limit(1)
+      .maybeSingle();
 
     if (!coeffData) {
       return NextResponse.json(
@@ -0,0 +1,356 @@
+"""
+Benchmark hors ligne de la migration.
+
+Exécute le flux complet `migrate.main()` contre un faux Supabase en mémoire
+(fake_supabase.py) alimenté par un catalogue synthétique, avec latence et
+taux d'échec injectables, puis affiche la durée et le nombre de requêtes
+par phase. Aucun projet Supabase réel n'est contacté.
+
+Usage :
+  cd migration
+  python benchmark.py --products 5000 --group-size 4 --latency-ms 20
+  python benchmark.py --products 2000 --batch-size 100 --image-workers 16 --json bench.json
+  python benchmark.py --products 5000 --batch-size 200 --product-workers 4
+  python benchmark.py --products 5000 --loader rpc
+  python benchmark.py --products 5000 --staging
+
+Le paramétrage de la migration (MIGRATION_BATCH_SIZE, ...) peut aussi être
+passé par variables d'environnement, comme pour un vrai run.
+"""
+
+import argparse
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+from fake_supabase import FakeClient, FakeImageServer, Latency
+
+PHASES = [
+    "fetch_old_data",
+    "clean_existing_data",
+    "preflight_images",
+    "reset_staging",
+    "migrate_categories",
+    "migrate_brands",
+    "migrate_products",
+    "sync_products",
+    "swap_staging",
+    "migrate_prices",
+    "collect_storage_garbage",
+]
+
+
+# ============================================================
+# Catalogue synthétique (schéma de l'ancien projet)
+# ============================================================
+def generate_catalog(
+    products=1000,
+    group_size=3,
+    categories=40,
+    brands=60,
+    specialties=25,
+    specialty_fanout=3,
+    shared_images=0.5,
+    seed=42,
+):
+    """
+    Génère (products, pricing, categories) au format de l'ancien projet.
+    `group_size` : variantes par product_group_uid ; `specialty_fanout` :
+    spécialités max par produit ; `shared_images` : part des groupes dont
+    toutes les variantes partagent la même URL d'image.
+    """
+    rng = random.Random(seed)
+    spec_names = [f"Spécialité {i}" for i in range(specialties)]
+    materials = ["Informatique", "Mobilier", "Médical"]
+
+    old_categories = [
+        {
+            "id": i,
+            "name": f"Catégorie {i}",
+            "material_type": rng.choice(materials),
+            "image": f"https://cdn.example.test/categories/{i}.jpg",
+            "product_family": f"Famille {i % 7}",
+            "speciality": json.dumps(rng.sample(spec_names, min(2, len(spec_names)))),
+        }
+        for i in range(1, categories + 1)
+    ]
+
+    old_products = []
+    old_pricing = []
+    for i in range(1, products + 1):
+        group = (i - 1) // max(1, group_size)
+        first_in_group = (i - 1) % max(1, group_size) == 0
+        if first_in_group:
+            group_shared = rng.random() < shared_images
+        old_pricing.append({
+            "id": i,
+            "marlon_margin": rng.choice([None, 20, 25, 30, 35]),
+            "provider_price": round(rng.uniform(50, 5000), 2),
+        })
+        image = (
+            f"https://cdn.example.test/groups/{group}.jpg" if group_shared
+            else f"https://cdn.example.test/products/{i}.jpg"
+        )
+        old_products.append({
+            "id": i,
+            "name": f"Produit {i}",
+            "serial_number": f"SN-{i // 2}",  # doublons volontaires
+            "description": "Description " * 20,
+            "provider_price": None,
+            "pricing": i,
+            "brand": f"Marque {rng.randrange(brands)}",
+            "product_type": rng.choice(["informatique", "mobilier", "medical"]),
+            "filter_color": rng.choice([None, "Noir", "Blanc"]),
+            "filter_processor": None,
+            "filter_storage": None,
+            "filter_screenSize": None,
+            "product_family": None,
+            "product_group_uid": f"group-{group}" if group_size > 1 else None,
+            "is_cheapest_in_group": first_in_group,
+            "technicals_informations": None,
+            "created_at": "2024-01-01T00:00:00+00:00",
+            "image": image,
+            "category": rng.randint(1, categories),
+            "speciality": json.dumps(rng.sample(spec_names, rng.randint(0, min(specialty_fanout, len(spec_names))))),
+        })
+    return old_products, old_pricing, old_categories
+
+
+def generate_orders(old_products, ordered, seed=42):
+    """
+    Produits créés par l'ancien script de migration (id aléatoire, référence =
+    numéro de série) et encore liés à des commandes : `ordered` produits du
+    nouveau projet et leurs order_items, conservés par le nettoyage.
+    """
+    rng = random.Random(seed)
+    first_by_serial = {}
+    for p in sorted(old_products, key=lambda p: p["id"]):
+        first_by_serial.setdefault(p["serial_number"], p)
+    picked = rng.sample(list(first_by_serial.values()), min(ordered, len(first_by_serial)))
+    products = [
+        {"id": str(uuid.UUID(int=rng.getrandbits(128))), "name": p["name"], "reference": p["serial_number"]}
+        for p in picked
+    ]
+    orders = [{"id": str(uuid.UUID(int=rng.getrandbits(128))), "product_id": p["id"]} for p in products]
+    return products, orders
+
+
+def generate_leasing(leasers=3, months=(24, 36, 48, 60), tranches=(0, 500, 2000, 10000)):
+    """
+    Grille de leasing du nouveau projet : (leasers, leasing_durations,
+    leaser_coefficients), une tranche par borne de `tranches` et par durée,
+    la dernière sans plafond.
+    """
+    leaser_rows = [{"id": f"leaser-{i}", "name": f"Leaser {i}"} for i in range(leasers)]
+    duration_rows = [{"id": f"duration-{m}", "months": m} for m in months]
+    coefficient_rows = []
+    for leaser in leaser_rows:
+        for duration in duration_rows:
+            for j, low in enumerate(tranches):
+                high = tranches[j + 1] - 0.01 if j + 1 < len(tranches) else None
+                coefficient_rows.append({
+                    "id": f"{leaser['id']}:{duration['id']}:{low}",
+                    "leaser_id": leaser["id"],
+                    "duration_id": duration["id"],
+                    "min_amount": low,
+                    "max_amount": high,
+                    "coefficient": round(120 / duration["months"] * (1 - 0.02 * j), 4),
+                })
+    return leaser_rows, duration_rows, coefficient_rows
+
+
+# ============================================================
+# Exécution
+# ============================================================
+def load_migrate(workdir):
+    """Importe migrate.py avec des fichiers d'état isolés dans `workdir`."""
+    for var, name in [
+        ("MIGRATION_IMAGE_CACHE", "image_cache.sqlite"),
+        ("MIGRATION_STATE", "migration_state.json"),
+        ("MIGRATION_CHECKPOINT", "migration_checkpoint.json"),
+        ("MIGRATION_REPORT", "migration_report.json"),
+        ("MIGRATION_PLAN", "migration_plan.json"),
+    ]:
+        os.environ[var] = os.path.join(workdir, name)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import migrate
+    return migrate
+
+
+def instrument_phases(migrate, old_client, new_client, images, results):
+    """Enveloppe chaque phase pour relever durée et requêtes émises."""
+    def wrap(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            before = (old_client.total_requests(), new_client.total_requests(), images.requests)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                results.append({
+                    "phase": func.__name__,
+                    "seconds": round(time.perf_counter() - start, 3),
+                    "old_requests": old_client.total_requests() - before[0],
+                    "new_requests": new_client.total_requests() - before[1],
+                    "image_requests": images.requests - before[2],
+                })
+        return wrapper
+
+    for name in PHASES:
+        setattr(migrate, name, wrap(getattr(migrate, name)))
+
+
+def run_until_complete(migrate, ctx, argv, max_resumes):
+    """
+    Lance la migration ; si une panne injectée l'interrompt, relance avec
+    --resume comme le ferait un opérateur. Retourne le nombre d'interruptions.
+    """
+    crashes = 0
+    while True:
+        try:
+            migrate.main(argv if crashes == 0 else ["--resume"], ctx=ctx)
+            return crashes
+        except Exception as e:
+            crashes += 1
+            print(f"\n💥 Run interrompu ({e}), reprise {crashes}/{max_resumes}")
+            if crashes >= max_resumes:
+                raise
+
+
+def run_benchmark(args):
+    catalog = generate_catalog(
+        products=args.products,
+        group_size=args.group_size,
+        categories=args.categories,
+        brands=args.brands,
+        specialties=args.specialties,
+        specialty_fanout=args.specialty_fanout,
+        shared_images=args.shared_images,
+        seed=args.seed,
+    )
+
+    workdir = tempfile.mkdtemp(prefix="marlon-bench-")
+    migrate = load_migrate(workdir)
+    if args.batch_size:
+        migrate.BATCH_SIZE = args.batch_size
+    if args.image_workers:
+        migrate.IMAGE_WORKERS = args.image_workers
+    if args.product_workers:
+        migrate.PRODUCT_WORKERS = args.product_workers
+    if args.loader:
+        migrate.LOADER = args.loader
+    # Les runs s'enchaînent en quelques secondes : pas de délai de grâce
+    migrate.STORAGE_GC_GRACE = 0
+
+    def latency(ms):
+        return Latency(ms, jitter_ms=ms / 2, failure_rate=args.failure_rate, seed=args.seed)
+
+    old_client = FakeClient("http://old.fake.local", latency(args.latency_ms))
+    new_client = FakeClient("http://new.fake.local", latency(args.latency_ms))
+    old_products, old_pricing, old_categories = catalog
+    image_urls = sorted({row["image"] for row in old_products + old_categories if row.get("image")})
+    dead_urls = random.Random(args.seed).sample(image_urls, int(len(image_urls) * args.dead_images))
+    images = FakeImageServer(args.image_bytes, latency(args.image_latency_ms), dead_urls)
+    old_client.load("product", old_products)
+    old_client.load("pricing", old_pricing)
+    old_client.load("category", old_categories)
+    leasers, durations, coefficients = generate_leasing(args.leasers)
+    new_client.load("leasers", leasers)
+    new_client.load("leasing_durations", durations)
+    new_client.load("leaser_coefficients", coefficients)
+    kept_products, orders = generate_orders(old_products, args.ordered, args.seed)
+    new_client.load("products", kept_products)
+    new_client.load("order_items", orders)
+
+    ctx = migrate.MigrationContext(
+        old_url=old_client.url, new_url=new_client.url,
+        old_client=old_client, new_client=new_client, http=images,
+    )
+
+    runs = []
+    modes = [["--staging"] if args.staging else []] + ([["--incremental"]] if args.incremental else [])
+    for argv in modes:
+        if args.dry_run:
+            plan = migrate.main(argv + ["--dry-run"], ctx=ctx)
+            runs.append({"mode": f"plan {argv[0].lstrip('-') if argv else 'full'}", "plan": plan,
+                         "requests_estimated": plan["requests"]["total"]})
+        phases = []
+        instrument_phases(migrate, old_client, new_client, images, phases)
+        start = time.perf_counter()
+        crashes = run_until_complete(migrate, ctx, argv, args.max_resumes)
+        runs.append({
+            "mode": argv[0].lstrip("-") if argv else "full",
+            "wall_s": round(time.perf_counter() - start, 3),
+            "crashes": crashes,
+            "phases": phases,
+            "requests": {"old": old_client.total_requests(), "new": new_client.total_requests(),
+                         "images": images.requests},
+            "report": migrate.metrics.report(),
+        })
+        for name in PHASES:  # retirer l'enveloppe avant le run suivant
+            setattr(migrate, name, getattr(migrate, name).__wrapped__)
+    return {"params": vars(args), "workdir": workdir, "runs": runs}
+
+
+def print_summary(result):
+    print("\n═══════════════════════════════════════════════════")
+    print("🏁 BENCHMARK")
+    print("═══════════════════════════════════════════════════")
+    for run in result["runs"]:
+        if "plan" in run:
+            print(f"  {run['mode']} : ~{run['requests_estimated']} requêtes estimées")
+            continue
+        print(f"  Run {run['mode']} : {run['wall_s']:.2f} s, {run['crashes']} reprise(s)")
+        print(f"    {'phase':<24} {'durée':>8} {'old':>7} {'new':>7} {'images':>7}")
+        for phase in run["phases"]:
+            print(f"    {phase['phase']:<24} {phase['seconds']:>7.2f}s {phase['old_requests']:>7} "
+                  f"{phase['new_requests']:>7} {phase['image_requests']:>7}")
+    print("═══════════════════════════════════════════════════")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hors ligne de migrate.py")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--group-size", type=int, default=3, help="variantes par groupe")
+    parser.add_argument("--categories", type=int, default=40)
+    parser.add_argument("--brands", type=int, default=60)
+    parser.add_argument("--specialties", type=int, default=25)
+    parser.add_argument("--specialty-fanout", type=int, default=3, help="spécialités max par produit")
+    parser.add_argument("--shared-images", type=float, default=0.5, help="part des groupes à image partagée")
+    parser.add_argument("--leasers", type=int, default=3, help="leasers de la grille de coefficients")
+    parser.add_argument("--image-bytes", type=int, default=50_000)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="latence par requête Supabase")
+    parser.add_argument("--image-latency-ms", type=float, default=20.0, help="latence par image")
+    parser.add_argument("--ordered", type=int, default=0,
+                        help="produits de l'ancien script (id aléatoire) liés à des commandes")
+    parser.add_argument("--dead-images", type=float, default=0.0, help="part des URLs d'images en 404 (0-1)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="taux d'échec injecté (0-1)")
+    parser.add_argument("--max-resumes", type=int, default=50, help="reprises max après une panne")
+    parser.add_argument("--batch-size", type=int, help="surcharge MIGRATION_BATCH_SIZE")
+    parser.add_argument("--image-workers", type=int, help="surcharge MIGRATION_IMAGE_WORKERS")
+    parser.add_argument("--product-workers", type=int, help="surcharge MIGRATION_PRODUCT_WORKERS")
+    parser.add_argument("--loader", choices=["rest", "rpc"], help="surcharge MIGRATION_LOADER")
+    parser.add_argument("--staging", action="store_true", help="run complet en tables fantômes (--staging)")
+    parser.add_argument("--incremental", action="store_true", help="enchaîne un run --incremental")
+    parser.add_argument("--dry-run", action="store_true", help="planifie chaque run (--dry-run) avant de l'exécuter")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="écrit le résultat complet dans ce fichier")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run_benchmark(args)
+    print_summary(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+"""
+Faux Supabase en mémoire pour mesurer migrate.py hors ligne.
+
+Reproduit le sous-ensemble de l'API supabase-py utilisé par la migration :
+  - tables façon PostgREST : select (projection), insert / upsert multi-lignes,
+    update, delete, filtres eq / neq / gt / in_ / not_.in_, order, limit ;
+  - fonctions SQL appelées par `rpc` (RPC_FUNCTIONS), atomiques ;
+  - Storage : upload, list (paginé), remove, get_public_url ;
+  - un faux serveur d'images (`FakeImageServer.get` / `head`, signatures de requests).
+
+Chaque requête peut subir une latence et un taux d'échec configurables,
+et est comptée par type (`client.counters`) pour les rapports de benchmark.
+"""
+
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class FakeAPIError(Exception):
+    """Erreur renvoyée par le faux PostgREST / Storage (contrainte, panne injectée)."""
+
+
+class FakeHTTPError(Exception):
+    """Statut HTTP >= 400 renvoyé par le faux serveur d'images."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class Latency:
+    """Latence simulée (ms, avec gigue) et taux d'échec injecté."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, failure_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def wait(self, what):
+        with self.lock:
+            delay = self.latency_ms + self.random.uniform(0, self.jitter_ms)
+            failed = self.random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if failed:
+            raise FakeAPIError(f"panne injectée ({what})")
+
+
+# Contraintes d'unicité et cascades du schéma cible utilisées par la migration
+UNIQUE_KEYS = {
+    "products": [("reference",)],
+    "brands": [("name",)],
+    "specialties": [("name",)],
+    "product_categories": [("product_id", "category_id")],
+    "product_specialties": [("product_id", "specialty_id")],
+    "category_specialties": [("category_id", "specialty_id")],
+    "product_prices": [("product_id", "leaser_id", "duration_id")],
+}
+
+# Tables fantômes du mode --staging (migration 019) : mêmes contraintes d'unicité
+STAGED_TABLES = [
+    "brands", "categories", "category_specialties", "products",
+    "product_images", "product_categories", "product_specialties",
+]
+UNIQUE_KEYS.update({f"staging_{t}": UNIQUE_KEYS[t] for t in STAGED_TABLES if t in UNIQUE_KEYS})
+
+CASCADES = {
+    "products": [
+        ("product_images", "product_id"),
+        ("product_categories", "product_id"),
+        ("product_specialties", "product_id"),
+        ("cart_items", "product_id"),
+        ("product_prices", "product_id"),
+    ],
+    "categories": [
+        ("category_specialties", "category_id"),
+        ("product_categories", "category_id"),
+    ],
+    "specialties": [
+        ("category_specialties", "specialty_id"),
+        ("product_specialties", "specialty_id"),
+    ],
+}
+
+
+class FakeQuery:
+    """Constructeur de requête chaînable, exécuté sur `FakeClient.tables`."""
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.columns = "*"
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.max_rows = None
+        self.want_count = False
+        self.return_rows = True
+        self._negate = False
+
+    # --- actions ---
+    def select(self, columns="*", count=None):
+        self.action, self.columns = "select", columns
+        self.want_count = count is not None
+        return self
+
+    def insert(self, rows, **_):
+        self.action, self.payload = "insert", rows
+        return self
+
+    def upsert(self, rows, **_):
+        self.action, self.payload = "upsert", rows
+        return self
+
+    def update(self, values, **_):
+        self.action, self.payload = "update", values
+        return self
+
+    def delete(self, count=None, returning="representation"):
+        self.action = "delete"
+        self.want_count = count is not None
+        self.return_rows = returning != "minimal"
+        return self
+
+    # --- filtres ---
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def _filter(self, predicate):
+        negate, self._negate = self._negate, False
+        self.filters.append((lambda row: not predicate(row)) if negate else predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda row: row.get(column) == value)
+
+    def neq(self, column, value):
+        return self._filter(lambda row: row.get(column) != value)
+
+    def gt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) > value)
+
+    def in_(self, column, values):
+        values = set(values)
+        return self._filter(lambda row: row.get(column) in values)
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.max_rows = count
+        return self
+
+    # --- exécution ---
+    def execute(self):
+        self.client.count_request(f"{self.action}:{self.table}")
+        self.client.latency.wait(f"{self.action} {self.table}")
+        with self.client.lock:
+            return getattr(self, f"_exec_{self.action}")()
+
+    def _rows(self):
+        return self.client.tables.setdefault(self.table, {})
+
+    def _matching(self):
+        rows = [r for r in self._rows().values() if all(f(r) for f in self.filters)]
+        if self.order_by:
+            column, desc = self.order_by
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+        if self.max_rows is not None:
+            rows = rows[:self.max_rows]
+        return rows
+
+    def _project(self, row):
+        if self.columns.strip() == "*":
+            return dict(row)
+        return {c.strip(): row.get(c.strip()) for c in self.columns.split(",")}
+
+    def _exec_select(self):
+        rows = self._matching()
+        total = None
+        if self.want_count:  # count="exact" : total avant limit, comme PostgREST
+            max_rows, self.max_rows = self.max_rows, None
+            total = len(self._matching())
+            self.max_rows = max_rows
+        return FakeResponse([self._project(r) for r in rows], total)
+
+    def _unique_indexes(self):
+        """{clé unique: {valeurs: id}} sur les lignes existantes (un passage par requête)."""
+        indexes = {}
+        for key in UNIQUE_KEYS.get(self.table, []):
+            index = indexes[key] = {}
+            for row in self._rows().values():
+                values = tuple(row.get(c) for c in key)
+                if None not in values:
+                    index[values] = row["id"]
+        return indexes
+
+    def _check_unique(self, indexes, row):
+        for key, index in indexes.items():
+            values = tuple(row.get(c) for c in key)
+            if None in values:
+                continue
+            owner = index.get(values)
+            if owner is not None and owner != row["id"]:
+                raise FakeAPIError(f"duplicate key value violates unique constraint {self.table}{key}")
+
+    def _exec_insert(self, upsert=False, ignore_conflicts=False):
+        """`ignore_conflicts` : lignes en conflit ignorées (ON CONFLICT DO NOTHING)."""
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        table = self._rows()
+        indexes = self._unique_indexes()
+        staged = {}
+        for row in rows:
+            row = dict(row)
+            row.setdefault("id", str(uuid.uuid4()))
+            existing = table.get(row["id"]) or staged.get(row["id"])
+            try:
+                if existing is not None and not upsert:
+                    raise FakeAPIError(f"duplicate key value violates unique constraint {self.table}_pkey")
+                merged = {**existing, **row} if existing else {"created_at": None, **row}
+                self._check_unique(indexes, merged)
+            except FakeAPIError:
+                if ignore_conflicts:
+                    continue
+                raise
+            for key, index in indexes.items():
+                if existing is not None:
+                    index.pop(tuple(existing.get(c) for c in key), None)
+                values = tuple(merged.get(c) for c in key)
+                if None not in values:
+                    index[values] = merged["id"]
+            staged[row["id"]] = merged
+        table.update(staged)  # lot atomique : rien n'est écrit si une ligne échoue
+        return FakeResponse([dict(r) for r in staged.values()])
+
+    def _exec_upsert(self):
+        return self._exec_insert(upsert=True)
+
+    def _exec_update(self):
+        rows = self._matching()
+        for row in rows:
+            row.update(self.payload)
+        return FakeResponse([dict(r) for r in rows])
+
+    def _exec_delete(self):
+        rows = self._matching()
+        for row in rows:
+            self._rows().pop(row["id"], None)
+        self.client.cascade(self.table, set(r["id"] for r in rows))
+        return FakeResponse(
+            [dict(r) for r in rows] if self.return_rows else [],
+            len(rows) if self.want_count else None,
+        )
+
+
+class FakeRPC:
+    """Appel de fonction SQL (`client.rpc(nom, params)`), exécuté atomiquement."""
+
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        client = self.client
+        client.count_request(f"rpc:{self.name}")
+        client.latency.wait(f"rpc {self.name}")
+        handler = RPC_FUNCTIONS.get(self.name)
+        if handler is None:
+            raise FakeAPIError(f"function {self.name} does not exist")
+        with client.lock:
+            snapshot = {table: dict(rows) for table, rows in client.tables.items()}
+            try:
+                return FakeResponse(handler(client, **self.params))
+            except Exception:
+                client.tables = snapshot  # transaction annulée
+                raise
+
+
+def rpc_migrate_products_batch(client, payload):
+    """Équivalent en mémoire de supabase/migrations/018_migrate_products_batch_function.sql."""
+    def query(table):
+        return FakeQuery(client, table)
+
+    def insert_ignoring_conflicts(table, rows):
+        if not rows:
+            return 0
+        return len(query(table).insert(rows)._exec_insert(ignore_conflicts=True).data)
+
+    products = payload.get("products") or []
+    rows = [{k: v for k, v in p.items() if k not in ("old_id", "parent_id")} for p in products]
+    for row, existing in ((r, client.tables.get("products", {}).get(r["id"])) for r in rows):
+        if existing is not None:
+            row["created_at"] = existing.get("created_at")
+    written = query("products").upsert(rows)._exec_upsert().data if rows else []
+    written_ids = set(r["id"] for r in written)
+    id_map = {p["old_id"]: p["id"] for p in products if p["id"] in written_ids}
+
+    if payload.get("replace_links"):
+        for table in ("product_images", "product_categories", "product_specialties"):
+            query(table).in_("product_id", written_ids)._exec_delete()
+
+    images = payload.get("images") or []
+    if images:
+        query("product_images").upsert(images)._exec_upsert()
+    categories = insert_ignoring_conflicts("product_categories", payload.get("categories") or [])
+    specialties = insert_ignoring_conflicts("product_specialties", payload.get("specialties") or [])
+
+    parents = 0
+    table = client.tables.get("products", {})
+    for p in products:
+        row = table.get(p["id"])
+        if p.get("parent_id") and p["parent_id"] in table and row.get("parent_product_id") != p["parent_id"]:
+            row["parent_product_id"] = p["parent_id"]
+            parents += 1
+
+    return {
+        "products": id_map,
+        "images": len(images),
+        "categories": categories,
+        "specialties": specialties,
+        "parents": parents,
+    }
+
+
+def rpc_reset_catalog_staging(client):
+    """Équivalent en mémoire de reset_catalog_staging() (migration 019)."""
+    for table in STAGED_TABLES:
+        client.tables.pop(f"staging_{table}", None)
+
+
+def check_unique(table, rows):
+    """Contraintes UNIQUE de `table` sur un ensemble de lignes {id: ligne}."""
+    for key in UNIQUE_KEYS.get(table, []):
+        seen = set()
+        for row in rows.values():
+            values = tuple(row.get(c) for c in key)
+            if None in values:
+                continue
+            if values in seen:
+                raise FakeAPIError(
+                    f"duplicate key value violates unique constraint {table}_{'_'.join(key)}_key: {values}"
+                )
+            seen.add(values)
+
+
+def rpc_swap_catalog_staging(client, expected):
+    """
+    Équivalent en mémoire de swap_catalog_staging(expected) (migration 019) ;
+    une violation d'unicité dans les tables en ligne annule toute la bascule.
+    """
+    tables = client.tables
+
+    def staged(table):
+        return tables.get(f"staging_{table}", {})
+
+    for table in ("brands", "categories", "products"):
+        if table in expected and len(staged(table)) != expected[table]:
+            raise FakeAPIError(f"staging_{table} has {len(staged(table))} rows, expected {expected[table]}")
+    if not staged("products"):
+        raise FakeAPIError("staging_products is empty, refusing to swap")
+
+    for table in ("product_variant_filters_junction", "product_variants", "product_documents", "cart_items",
+                  "product_images", "product_specialties", "product_categories",
+                  "category_specialties", "category_it_types"):
+        tables.pop(table, None)
+
+    ordered = set(r.get("product_id") for r in tables.get("order_items", {}).values())
+    tables["products"] = {
+        pid: {**row, "parent_product_id": None}
+        for pid, row in tables.get("products", {}).items()
+        if pid in ordered or pid in staged("products")
+    }
+    tables["categories"] = {cid: row for cid, row in tables.get("categories", {}).items() if cid in staged("categories")}
+
+    def drop_unused_brands():
+        used = set(p.get("brand_id") for p in tables["products"].values())
+        tables["brands"] = {
+            bid: row for bid, row in tables.get("brands", {}).items()
+            if bid in used or bid in staged("brands")
+        }
+
+    drop_unused_brands()
+    live_names = {b["name"]: bid for bid, b in tables["brands"].items()}
+    remap = {
+        bid: live_names[b["name"]] for bid, b in staged("brands").items()
+        if live_names.get(b["name"], bid) != bid
+    }
+    staged_products = staged("products")
+    for pid, row in list(staged_products.items()):
+        if row.get("brand_id") in remap:
+            staged_products[pid] = {**row, "brand_id": remap[row["brand_id"]]}
+
+    copied = {}
+    for table in ("brands", "categories", "category_specialties", "products",
+                  "product_images", "product_categories", "product_specialties"):
+        live = tables.setdefault(table, {})
+        rows = {rid: row for rid, row in staged(table).items() if rid not in remap}
+        for rid, row in rows.items():
+            existing = live.get(rid)
+            live[rid] = {**row, "created_at": existing.get("created_at")} if existing else dict(row)
+        copied[table] = len(rows)
+
+    drop_unused_brands()
+    for table in copied:
+        check_unique(table, tables[table])
+    return copied
+
+
+RPC_FUNCTIONS = {
+    "migrate_products_batch": rpc_migrate_products_batch,
+    "reset_catalog_staging": rpc_reset_catalog_staging,
+    "swap_catalog_staging": rpc_swap_catalog_staging,
+}
+
+
+class FakeBucket:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def _objects(self):
+        return self.storage.buckets.setdefault(self.name, {})
+
+    def upload(self, path, file, file_options=None):
+        client = self.storage.client
+        client.count_request("storage:upload")
+        client.latency.wait("storage upload")
+        if isinstance(file, str):  # chemin de fichier, comme storage3
+            with open(file, "rb") as f:
+                file = f.read()
+        file_bytes = file
+        with client.lock:
+            self._objects()[path] = bytes(file_bytes)
+            self.storage.updated_at[(self.name, path)] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+            client.bytes_uploaded += len(file_bytes)
+        return {"Key": f"{self.name}/{path}"}
+
+    def get_public_url(self, path):
+        return f"{self.storage.client.url}/storage/v1/object/public/{self.name}/{path}"
+
+    def list(self, folder="", options=None):
+        client = self.storage.client
+        client.count_request("storage:list")
+        client.latency.wait("storage list")
+        options = options or {}
+        prefix = f"{folder}/" if folder else ""
+        entries = {}
+        with client.lock:
+            for path in self._objects():
+                if not path.startswith(prefix):
+                    continue
+                head, _, rest = path[len(prefix):].partition("/")
+                if rest:
+                    entries.setdefault(head, {"name": head, "id": None})
+                else:
+                    entries[head] = {
+                        "name": head, "id": path, "metadata": {"size": len(self._objects()[path])},
+                        "updated_at": self.storage.updated_at.get((self.name, path)),
+                    }
+        ordered = [entries[k] for k in sorted(entries)]
+        offset = options.get("offset", 0)
+        return ordered[offset:offset + options.get("limit", 100)]
+
+    def remove(self, paths):
+        client = self.storage.client
+        client.count_request("storage:remove")
+        client.latency.wait("storage remove")
+        with client.lock:
+            for path in paths:
+                self._objects().pop(path, None)
+        return []
+
+
+class FakeStorage:
+    def __init__(self, client):
+        self.client = client
+        self.buckets = {}
+        self.updated_at = {}  # (bucket, chemin) → date ISO du dernier upload
+
+    def from_(self, bucket):
+        return FakeBucket(self, bucket)
+
+
+class FakeClient:
+    """Client Supabase en mémoire (tables + Storage)."""
+
+    def __init__(self, url="http://fake.supabase.local", latency=None):
+        self.url = url.rstrip("/")
+        self.latency = latency or Latency()
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.storage = FakeStorage(self)
+        self.counters = {}
+        self.bytes_uploaded = 0
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params=None):
+        return FakeRPC(self, name, params or {})
+
+    def count_request(self, kind):
+        with self.lock:
+            self.counters[kind] = self.counters.get(kind, 0) + 1
+
+    def total_requests(self):
+        return sum(self.counters.values())
+
+    def cascade(self, table, deleted_ids):
+        """Reproduit les ON DELETE CASCADE du schéma."""
+        for child, column in CASCADES.get(table, []):
+            rows = self.tables.get(child, {})
+            doomed = [rid for rid, row in rows.items() if row.get(column) in deleted_ids]
+            for rid in doomed:
+                rows.pop(rid)
+            if doomed:
+                self.cascade(child, set(doomed))
+
+    def load(self, table, rows):
+        """Précharge des lignes (sans compter de requête)."""
+        self.tables.setdefault(table, {}).update({r["id"]: dict(r) for r in rows})
+
+
+class FakeHTTPResponse:
+    def __init__(self, url, status_code, content, content_type):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"Content-Type": content_type, "Content-Length": str(len(content))}
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise FakeHTTPError(f"{self.status_code} pour {self.url}", response=self)
+
+
+class FakeImageServer:
+    """
+    Faux CDN d'images : chaque URL renvoie des octets déterministes de
+    `image_bytes` octets. Les URLs listées dans `dead_urls` renvoient 404.
+    """
+
+    def __init__(self, image_bytes=50_000, latency=None, dead_urls=()):
+        self.image_bytes = image_bytes
+        self.latency = latency or Latency()
+        self.dead_urls = set(dead_urls)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_served = 0
+
+    def body(self, url):
+        seed = url.encode()
+        return (seed * (self.image_bytes // max(1, len(seed)) + 1))[:self.image_bytes]
+
+    def head(self, url, timeout=None, **_):
+        with self.lock:
+            self.requests += 1
+        self.latency.wait(f"HEAD {url}")
+        if url in self.dead_urls:
+            return FakeHTTPResponse(url, 404, b"", "text/html")
+        response = FakeHTTPResponse(url, 200, b"", "image/jpeg")
+        response.headers["Content-Length"] = str(self.image_bytes)
+        return response
+
+    def get(self, url, timeout=None, **_):
+        with self.lock:
+            self.requests += 1
+        self.latency.wait(f"GET {url}")
+        if url in self.dead_urls:
+            return FakeHTTPResponse(url, 404, b"", "text/html")
+        content = self.body(url)
+        with self.lock:
+            self.bytes_served += len(content)
+        return FakeHTTPResponse(url, 200, content, "image/jpeg")
@@ -8,29 +8,86 @@ Usage :
   pip install supabase python-dotenv requests
   cd migration
   python migrate.py
+
+Variables optionnelles (.env) :
+  MIGRATION_BATCH_SIZE   taille des lots d'insertion (défaut 500, 1 = ligne à ligne)
+  MIGRATION_IMAGE_WORKERS  transferts d'images simultanés (défaut 8)
+  MIGRATION_IMAGE_PER_HOST connexions simultanées max par hôte (défaut 4)
+  MIGRATION_LOADER            rest = écritures PostgREST par table ; rpc = un appel par lot à la
+                              fonction SQL migrate_products_batch (migration 018), transactionnel
+                              (défaut rest)
+  MIGRATION_PRODUCT_WORKERS   shards de produits migrés en parallèle, un client par shard (défaut 1)
+  MIGRATION_IMAGE_MAX_BYTES   taille max d'une image source, rejetée dès le Content-Length (défaut 25 Mo)
+  MIGRATION_IMAGE_SPOOL_BYTES au-delà, l'image transite par un fichier temporaire et non en mémoire (défaut 1 Mo)
+  MIGRATION_RENDITIONS        déclinaisons nom:côté_max générées pour chaque image, ex. thumb:200,card:600,full:1600
+                              (défaut vide = images copiées telles quelles ; nécessite Pillow)
+  MIGRATION_RENDITION_FORMAT  webp ou avif (défaut webp ; avif : Pillow >= 11.3 ou pillow-avif-plugin)
+  MIGRATION_RENDITION_QUALITY qualité d'encodage 1-100 (défaut 80)
+  MIGRATION_RENDITION_WORKERS processus d'encodage (défaut : nombre de CPU)
+  MIGRATION_HTTP_POOL      connexions keep-alive conservées par hôte (défaut MIGRATION_IMAGE_PER_HOST)
+  MIGRATION_HTTP_RETRIES   relances d'un téléchargement / upload d'image en erreur transitoire (défaut 3)
+  MIGRATION_HTTP_BACKOFF   délai de base du backoff exponentiel, en secondes (défaut 0.5)
+  MIGRATION_HTTP_BACKOFF_MAX  délai max entre deux tentatives, Retry-After compris (défaut 30)
+  MIGRATION_PREFLIGHT      1 = vérifie d'abord (HEAD concurrents) les URLs d'images à transférer :
+                           URLs mortes ignorées, grosses images transférées en premier (défaut 1)
+  MIGRATION_PREFLIGHT_TIMEOUT  délai max d'une vérification, en secondes (défaut 5)
+  MIGRATION_URL_CHECK_TTL  durée de validité d'une vérification en cache, en heures (défaut 24) ;
+                           seules les réponses définitives (2xx, 404, 410...) sont mises en cache
+  MIGRATION_DEDUP_IMAGES   1 = images adressées par contenu, stockées une seule fois (défaut 1)
+  MIGRATION_STORAGE_GC     1 = en fin de run, supprime des buckets d'images les objets que plus
+                           aucune ligne ne référence ; les autres restent en place (défaut 1)
+  MIGRATION_STORAGE_GC_GRACE  âge min d'un objet orphelin supprimé, en heures : épargne les uploads
+                           du back-office pas encore enregistrés (défaut 1)
+  MIGRATION_IMAGE_CACHE    chemin du cache SQLite URL → objet Storage, par projet cible
+                           (défaut migration/image_cache.sqlite)
+  MIGRATION_STATE          chemin de l'état persistant (mappings + empreintes, défaut migration/migration_state.json)
+  MIGRATION_CHECKPOINT     chemin du journal de reprise (défaut migration/migration_checkpoint.json)
+  MIGRATION_REPORT         chemin du rapport JSON (durées, latences, débits ; défaut migration/migration_report.json)
+  MIGRATION_PROGRESS_INTERVAL  secondes entre deux lignes de progression (défaut 10)
+  MIGRATION_MEMORY_REPORT  1 = suivi mémoire tracemalloc (pic par phase, principaux sites
+                           d'allocation) dans le résumé et le rapport ; ralentit les phases
+                           gourmandes en CPU (défaut 0 : pic RSS du processus seulement)
+  MIGRATION_VERBOSE        1 = une ligne par catégorie / marque migrée (défaut 0)
+
+Options :
+  --incremental   synchronise uniquement le delta (nouveaux / modifiés / supprimés)
+                  sans vider le catalogue ; nécessite un état issu d'un run précédent
+  --resume        reprend un run interrompu depuis le dernier checkpoint
+  --staging       migration complète chargée dans les tables fantômes staging_*
+                  (migration 019) pendant que le site lit le catalogue en ligne,
+                  puis basculée en une transaction : le catalogue n'est jamais vide
+  --dry-run       n'écrit rien : calcule le plan (lignes à créer / mapper / mettre à
+                  jour par table, images et octets estimés, nombre de requêtes)
+                  et l'écrit dans MIGRATION_PLAN (défaut migration/migration_plan.json)
+
+Benchmark hors ligne (faux Supabase en mémoire) : python benchmark.py --help
 """
 
 import os
+import argparse
 import json
 import re
 import time
 import hashlib
+import sqlite3
+import sys
+import tempfile
+import threading
+import tracemalloc
 import unicodedata
-import requests
-from urllib.parse import urlparse
-from dotenv import load_dotenv
-from supabase import create_client
-
-# Charger le .env du même dossier
-load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+import random
+import uuid
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import unquote, urlparse
 
-OLD_SUPABASE_URL = os.environ["OLD_SUPABASE_URL"].rstrip("/")
-OLD_SUPABASE_KEY = os.environ["OLD_SUPABASE_KEY"]
-NEW_SUPABASE_URL = os.environ["NEW_SUPABASE_URL"].rstrip("/")
-NEW_SUPABASE_SERVICE_KEY = os.environ["NEW_SUPABASE_SERVICE_KEY"]
+# supabase, requests et python-dotenv ne sont importés qu'à la première
+# phase réseau (voir MigrationContext) : importer ce module reste instantané.
 
-old_sb = create_client(OLD_SUPABASE_URL, OLD_SUPABASE_KEY)
-new_sb = create_client(NEW_SUPABASE_URL, NEW_SUPABASE_SERVICE_KEY)
+ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
 
 # Mappings old id → new uuid
 category_map = {}
@@ -39,6 +96,133 @@ product_map = {}
 pricing_map = {}
 used_references = set()  # Pour éviter les doublons de reference
 
+# Empreintes de contenu des anciennes lignes (détection des modifications)
+product_hashes = {}
+category_hashes = {}
+category_created = set()  # anciens ids de catégories créées par la migration
+
+# Empreintes (prix d'achat, marge, grille de coefficients) des prix précalculés
+price_hashes = {}
+
+# Groupes de variantes du run (product_group_uid → anciens produits)
+variant_groups = {}
+
+# Référence attribuée à chaque ancien produit, calculée avant l'insertion
+reference_map = {}
+# Produits liés à des commandes conservés par le nettoyage : ancien id → id en base
+kept_product_ids = {}
+# Nouveaux ids des produits (ré)écrits pendant ce run : link_variants peut les réécrire en entier
+rewritten_products = set()
+
+# Protège l'état partagé (mappings, stats, index, journal) entre shards
+state_lock = threading.RLock()
+
+# Groupes de variantes sans parent au dernier passage de liaison (rapport)
+orphan_groups = []
+
+# Index nom normalisé → ligne, chargés une fois par table (categories, brands, specialties)
+name_indexes = {}
+
+# Vérifications des URLs d'images du run : url → (statut, taille, content-type)
+url_checks = {}
+
+# Phases terminées du run en cours (journal de reprise)
+phases_done = []
+
+CONTENT_FOLDER = "sha256"  # dossier des objets adressés par contenu (immuables, réutilisés)
+
+
+def parse_renditions(value):
+    """"thumb:200,card:600" → [("thumb", 200), ("card", 600)] ; ValueError si mal formé."""
+    renditions = []
+    for item in value.split(","):
+        if item.strip():
+            name, _, size = item.partition(":")
+            if not name.strip() or not size.strip().isdigit() or int(size) <= 0:
+                raise ValueError(f"déclinaison invalide : {item.strip()!r}")
+            renditions.append((name.strip(), int(size)))
+    return renditions
+
+
+def apply_env_settings():
+    """
+    (Re)lit les réglages MIGRATION_* de l'environnement. Appelée à l'import,
+    puis après chargement du .env par `MigrationContext.from_env`.
+    """
+    global BATCH_SIZE, LOADER, PRODUCT_WORKERS, IMAGE_WORKERS, IMAGE_PER_HOST, DEDUP_IMAGES, IMAGE_CACHE_PATH
+    global IMAGE_MAX_BYTES, IMAGE_SPOOL_BYTES
+    global RENDITIONS, RENDITIONS_SETTING, RENDITION_FORMAT, RENDITION_QUALITY, RENDITION_WORKERS
+    global HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, HTTP_BACKOFF_MAX
+    global PREFLIGHT, PREFLIGHT_TIMEOUT, URL_CHECK_TTL
+    global STORAGE_GC, STORAGE_GC_GRACE
+    global STATE_PATH, CHECKPOINT_PATH, REPORT_PATH, PLAN_PATH, PROGRESS_INTERVAL, VERBOSE, MEMORY_REPORT
+    here = os.path.dirname(__file__)
+
+    # Taille des lots pour les insertions groupées (1 = insertion ligne à ligne)
+    BATCH_SIZE = max(1, int(os.environ.get("MIGRATION_BATCH_SIZE", "500")))
+
+    # Chargement des produits : PostgREST table par table, ou fonction SQL par lot
+    LOADER = os.environ.get("MIGRATION_LOADER", "rest").lower()
+
+    # Shards de produits traités en parallèle (variantes d'un groupe dans le même shard)
+    PRODUCT_WORKERS = max(1, int(os.environ.get("MIGRATION_PRODUCT_WORKERS", "1")))
+
+    # Parallélisme du transfert d'images (pool global + limite par hôte)
+    IMAGE_WORKERS = max(1, int(os.environ.get("MIGRATION_IMAGE_WORKERS", "8")))
+    IMAGE_PER_HOST = max(1, int(os.environ.get("MIGRATION_IMAGE_PER_HOST", "4")))
+
+    # Transfert en flux : taille max acceptée, seuil de bascule mémoire → disque
+    IMAGE_MAX_BYTES = int(os.environ.get("MIGRATION_IMAGE_MAX_BYTES", str(25 * 1024 * 1024)))
+    IMAGE_SPOOL_BYTES = int(os.environ.get("MIGRATION_IMAGE_SPOOL_BYTES", str(1024 * 1024)))
+
+    # Déclinaisons redimensionnées / ré-encodées des images (étape optionnelle)
+    # (valeur mal formée : signalée par rendition_config_error, pas à l'import)
+    RENDITIONS_SETTING = os.environ.get("MIGRATION_RENDITIONS", "")
+    try:
+        RENDITIONS = parse_renditions(RENDITIONS_SETTING)
+    except ValueError:
+        RENDITIONS = []
+    RENDITION_FORMAT = os.environ.get("MIGRATION_RENDITION_FORMAT", "webp").lower()
+    RENDITION_QUALITY = int(os.environ.get("MIGRATION_RENDITION_QUALITY", "80"))
+    RENDITION_WORKERS = max(1, int(os.environ.get("MIGRATION_RENDITION_WORKERS", str(os.cpu_count() or 1))))
+
+    # Session HTTP poolée (keep-alive) et relances sur erreurs transitoires
+    HTTP_POOL_SIZE = max(1, int(os.environ.get("MIGRATION_HTTP_POOL", str(IMAGE_PER_HOST))))
+    HTTP_RETRIES = max(0, int(os.environ.get("MIGRATION_HTTP_RETRIES", "3")))
+    HTTP_BACKOFF = float(os.environ.get("MIGRATION_HTTP_BACKOFF", "0.5"))
+    HTTP_BACKOFF_MAX = float(os.environ.get("MIGRATION_HTTP_BACKOFF_MAX", "30"))
+
+    # Pré-vérification des URLs sources, résultats en cache (négatif compris) pendant le TTL
+    PREFLIGHT = os.environ.get("MIGRATION_PREFLIGHT", "1") != "0"
+    PREFLIGHT_TIMEOUT = float(os.environ.get("MIGRATION_PREFLIGHT_TIMEOUT", "5"))
+    URL_CHECK_TTL = float(os.environ.get("MIGRATION_URL_CHECK_TTL", "24")) * 3600
+
+    # Ramasse-miettes Storage par réconciliation avec les lignes en base
+    STORAGE_GC = os.environ.get("MIGRATION_STORAGE_GC", "1") != "0"
+    STORAGE_GC_GRACE = float(os.environ.get("MIGRATION_STORAGE_GC_GRACE", "1")) * 3600
+
+    # Déduplication des images par empreinte de contenu, persistée entre les relances
+    DEDUP_IMAGES = os.environ.get("MIGRATION_DEDUP_IMAGES", "1") != "0"
+    IMAGE_CACHE_PATH = os.environ.get("MIGRATION_IMAGE_CACHE", os.path.join(here, "image_cache.sqlite"))
+
+    # État persistant entre deux runs (mode incrémental) et journal de reprise
+    STATE_PATH = os.environ.get("MIGRATION_STATE", os.path.join(here, "migration_state.json"))
+    CHECKPOINT_PATH = os.environ.get("MIGRATION_CHECKPOINT", os.path.join(here, "migration_checkpoint.json"))
+
+    # Rapport de run et affichage de la progression
+    REPORT_PATH = os.environ.get("MIGRATION_REPORT", os.path.join(here, "migration_report.json"))
+    PLAN_PATH = os.environ.get("MIGRATION_PLAN", os.path.join(here, "migration_plan.json"))
+    PROGRESS_INTERVAL = float(os.environ.get("MIGRATION_PROGRESS_INTERVAL", "10"))
+    VERBOSE = os.environ.get("MIGRATION_VERBOSE", "0") == "1"
+    MEMORY_REPORT = os.environ.get("MIGRATION_MEMORY_REPORT", "0") == "1"
+
+
+apply_env_settings()
+
+# Espace de noms des UUID déterministes : une ligne ré-écrite après une reprise
+# garde le même id, les écritures sont donc idempotentes (upsert).
+ID_NAMESPACE = uuid.UUID("6f1c3f3e-6a0b-4d52-9a57-3c8a2f6d1e10")
+
 stats = {
     "products_total": 0,
     "products_migrated": 0,
@@ -49,11 +233,328 @@ stats = {
     "brands_mapped": 0,
     "images_uploaded": 0,
     "images_failed": 0,
+    "images_reused": 0,
+    "images_skipped": 0,
+    "image_urls_checked": 0,
+    "image_urls_dead": 0,
+    "storage_orphans_removed": 0,
+    "storage_objects_kept": 0,
+    "http_retries": 0,
     "specialties_linked": 0,
     "category_links": 0,
+    "links_failed": 0,
+    "products_updated": 0,
+    "products_unchanged": 0,
+    "products_deleted": 0,
+    "categories_unchanged": 0,
+    "categories_deleted": 0,
+    "variants_linked": 0,
+    "variants_failed": 0,
+    "groups_without_parent": 0,
+    "products_priced": 0,
+    "prices_written": 0,
+}
+
+
+# ============================================================
+# Contexte : connexions source / cible, créées à la demande
+# ============================================================
+class MigrationContext:
+    """
+    Connexions d'une migration : clients Supabase de l'ancien et du nouveau
+    projet et client HTTP des images, créés à leur première utilisation.
+    Plusieurs contextes (projets cibles différents, faux clients de
+    benchmark) peuvent coexister dans un même processus.
+    Avec `staging`, les écritures du catalogue visent les tables fantômes
+    (voir StagingClient) ; `live_sb` reste le client des tables en ligne.
+    """
+
+    def __init__(self, old_url="", old_key="", new_url="", new_key="",
+                 old_client=None, new_client=None, http=None, staging=False):
+        self.old_url = old_url.rstrip("/")
+        self.old_key = old_key
+        self.new_url = new_url.rstrip("/")
+        self.new_key = new_key
+        self._old_sb = old_client
+        self._new_sb = new_client
+        self._http = http
+        self._injected = (old_client, new_client, http)
+        self.staging = staging
+        self._lock = threading.Lock()
+
+    def fork(self):
+        """
+        Contexte de même configuration avec ses propres clients (un par shard).
+        Les clients injectés (faux clients de benchmark) restent partagés.
+        """
+        return MigrationContext(self.old_url, self.old_key, self.new_url, self.new_key, *self._injected,
+                                staging=self.staging)
+
+    @classmethod
+    def from_env(cls):
+        """Contexte configuré par migration/.env et l'environnement."""
+        from dotenv import load_dotenv
+
+        # Charger le .env du même dossier
+        load_dotenv(ENV_PATH)
+        apply_env_settings()
+        return cls(
+            os.environ["OLD_SUPABASE_URL"],
+            os.environ["OLD_SUPABASE_KEY"],
+            os.environ["NEW_SUPABASE_URL"],
+            os.environ["NEW_SUPABASE_SERVICE_KEY"],
+        )
+
+    def config_error(self):
+        """Message d'erreur si la configuration contient encore des valeurs d'exemple."""
+        if "XXXXXXXX" in self.old_url:
+            return "Renseigner les variables dans migration/.env !"
+        if "REMPLACER" in self.new_key:
+            return "Renseigner NEW_SUPABASE_SERVICE_KEY dans migration/.env !"
+        return None
+
+    @property
+    def old_sb(self):
+        with self._lock:
+            if self._old_sb is None:
+                from supabase import create_client
+                self._old_sb = create_client(self.old_url, self.old_key)
+        return self._old_sb
+
+    @property
+    def live_sb(self):
+        with self._lock:
+            if self._new_sb is None:
+                from supabase import create_client
+                self._new_sb = create_client(self.new_url, self.new_key)
+        return self._new_sb
+
+    @property
+    def new_sb(self):
+        return StagingClient(self.live_sb) if self.staging else self.live_sb
+
+    @property
+    def http(self):
+        """
+        Client HTTP des téléchargements d'images (objet exposant `get`) :
+        une `requests.Session` partagée, dont les connexions keep-alive
+        (HTTP_POOL_SIZE par hôte) sont réutilisées d'une image à l'autre.
+        """
+        with self._lock:
+            if self._http is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=IMAGE_WORKERS, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._http = session
+        return self._http
+
+
+# Tables du catalogue doublées par une table fantôme (migration 019)
+STAGING_PREFIX = "staging_"
+STAGED_TABLES = {
+    "brands", "categories", "category_specialties", "products",
+    "product_images", "product_categories", "product_specialties",
 }
 
 
+class StagingClient:
+    """
+    Client du nouveau projet dont les tables du catalogue sont remplacées
+    par leurs tables fantômes `staging_*` ; le reste (spécialités, Storage,
+    rpc) est celui du client en ligne.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def table(self, name):
+        return self.client.table(STAGING_PREFIX + name if name in STAGED_TABLES else name)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+# ============================================================
+# Mesures : durées par phase, latences par type d'appel distant
+# ============================================================
+def percentile(values, pct):
+    """Percentile (plus proche rang) d'une liste de valeurs."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus, en Mo ; None si indisponible (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1e6 if sys.platform == "darwin" else peak / 1e3, 1)  # octets sous macOS, Kio ailleurs
+
+
+class Metrics:
+    """
+    Compteurs thread-safe : pour chaque type d'appel distant (ex. `new_db.insert`,
+    `image.download`), nombre d'appels, erreurs, latences, lignes et octets ;
+    pour chaque phase, durée, lignes écrites et pic mémoire (tracemalloc,
+    si MEMORY_REPORT ; le pic d'une phase inclut ce qui tourne en parallèle).
+    """
+
+    WRITE_SUFFIXES = (".insert", ".upsert", ".update", ".delete", ".rpc")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.calls = {}
+        self.phases = {}
+        self.rows_written = 0
+        self.peak_bytes = 0
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def memory_peak(self):
+        """Pic de mémoire tracée depuis le dernier relevé, remis à zéro ; 0 sans suivi."""
+        if not tracemalloc.is_tracing():
+            return 0
+        with self.lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            self.peak_bytes = max(self.peak_bytes, peak)
+        return peak
+
+    def record(self, kind, seconds, rows=0, nbytes=0, error=False):
+        with self.lock:
+            call = self.calls.setdefault(kind, {"latencies": [], "errors": 0, "rows": 0, "bytes": 0})
+            call["latencies"].append(seconds)
+            call["rows"] += rows
+            call["bytes"] += nbytes
+            call["errors"] += 1 if error else 0
+            if kind.endswith(self.WRITE_SUFFIXES):
+                self.rows_written += rows
+
+    @contextmanager
+    def track(self, kind):
+        """Mesure un appel ; le bloc peut renseigner `rows` et `bytes`."""
+        call = {"rows": 0, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception:
+            self.record(kind, time.perf_counter() - start, call["rows"], call["bytes"], error=True)
+            raise
+        self.record(kind, time.perf_counter() - start, call["rows"], call["bytes"])
+
+    @contextmanager
+    def phase(self, name):
+        rows_before = self.rows_written
+        self.memory_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            rows = self.rows_written - rows_before
+            peak = self.memory_peak()
+            self.phases[name] = {
+                "seconds": round(seconds, 3),
+                "rows_written": rows,
+                "rows_per_s": round(rows / seconds, 1) if seconds else 0.0,
+            }
+            if peak:
+                self.phases[name]["peak_mb"] = round(peak / 1e6, 1)
+            memory = f", pic mémoire {peak / 1e6:.1f} Mo" if peak else ""
+            print(f"  ⏱️  {name} : {seconds:.1f} s, {rows} lignes écrites{memory}")
+
+    def memory_report(self, top=10):
+        """
+        Pic RSS du processus ; avec le suivi tracemalloc, mémoire tracée
+        (courante, pic du run) et principaux sites d'allocation encore vivants.
+        """
+        rss = peak_rss_mb()
+        if not tracemalloc.is_tracing():
+            return {"peak_rss_mb": rss}
+        self.memory_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        sites = tracemalloc.take_snapshot().statistics("lineno")[:top]
+        return {
+            "peak_rss_mb": rss,
+            "current_mb": round(current / 1e6, 1),
+            "peak_mb": round(self.peak_bytes / 1e6, 1),
+            "top": [
+                {"where": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+                 "mb": round(s.size / 1e6, 2), "blocks": s.count}
+                for s in sites
+            ],
+        }
+
+    def report(self):
+        calls = {}
+        for kind, call in sorted(self.calls.items()):
+            total = sum(call["latencies"])
+            calls[kind] = {
+                "count": len(call["latencies"]),
+                "errors": call["errors"],
+                "total_s": round(total, 3),
+                "p50_ms": round(percentile(call["latencies"], 50) * 1000, 1),
+                "p95_ms": round(percentile(call["latencies"], 95) * 1000, 1),
+                "rows": call["rows"],
+                "bytes": call["bytes"],
+                "rows_per_s": round(call["rows"] / total, 1) if total else 0.0,
+            }
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "duration_s": round(time.time() - self.started_at, 3),
+            "phases": self.phases,
+            "calls": calls,
+            "memory": self.memory_report(),
+            "stats": dict(stats),
+        }
+
+
+metrics = Metrics()
+_progress_last = {}
+
+
+def progress(label, done, total):
+    """Ligne de progression périodique (au plus une toutes les PROGRESS_INTERVAL s)."""
+    now = time.perf_counter()
+    if done < total and now - _progress_last.get(label, 0) < PROGRESS_INTERVAL:
+        return
+    _progress_last[label] = now
+    print(f"  ⏳ {label} : {done}/{total}")
+
+
+def log_row(message):
+    """Détail par ligne migrée, affiché seulement en mode verbeux."""
+    if VERBOSE:
+        print(message)
+
+
+def write_report():
+    """Écrit le rapport JSON du run et retourne son contenu."""
+    report = {**metrics.report(), "orphan_groups": list(orphan_groups)}
+    with open(REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+def count(key, n=1):
+    """Incrémente une stat ; sûr depuis les threads d'images et les shards."""
+    with state_lock:
+        stats[key] += n
+
+
 def reset_state():
     """Réinitialise tous les mappings et stats pour un relancement propre."""
     category_map.clear()
@@ -61,6 +562,22 @@ def reset_state():
     product_map.clear()
     pricing_map.clear()
     used_references.clear()
+    product_hashes.clear()
+    category_hashes.clear()
+    category_created.clear()
+    price_hashes.clear()
+    reference_map.clear()
+    kept_product_ids.clear()
+    rewritten_products.clear()
+    variant_groups.clear()
+    orphan_groups.clear()
+    url_checks.clear()
+    phases_done.clear()
+    name_indexes.clear()
+    if MEMORY_REPORT and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    metrics.reset()
+    _progress_last.clear()
     for key in stats:
         stats[key] = 0
 
@@ -75,6 +592,13 @@ def slugify(text):
     return text or "unnamed"
 
 
+def name_key(name):
+    """Clé de comparaison des noms : sans accents, sans casse, espaces normalisés."""
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
 def make_unique_reference(serial_number, old_id):
     """Génère une référence unique. Ajoute -oldID si doublon."""
     if not serial_number:
@@ -82,12 +606,152 @@ def make_unique_reference(serial_number, old_id):
     ref = serial_number.strip()
     if not ref:
         return None
-    if ref in used_references:
-        ref = f"{ref}-{old_id}"
-    used_references.add(ref)
+    with state_lock:
+        if ref in used_references:
+            ref = f"{ref}-{old_id}"
+        used_references.add(ref)
     return ref
 
 
+def reserve_references(old_products):
+    """
+    Attribue les références de tous les produits à écrire, par id croissant,
+    avant tout envoi : le résultat ne dépend ni du découpage en shards ni de
+    l'ordre d'exécution des lots, et reste identique après une reprise.
+    """
+    for old_p in sorted(old_products, key=lambda p: p["id"]):
+        reference_map[old_p["id"]] = make_unique_reference(old_p.get("serial_number"), old_p["id"])
+
+
+def stable_id(kind, *parts):
+    """UUID déterministe d'une ligne migrée (même entrée → même id)."""
+    return str(uuid.uuid5(ID_NAMESPACE, ":".join([kind, *map(str, parts)])))
+
+
+def new_product_id(old_id):
+    """Id du produit dans le nouveau projet : celui d'un produit commandé conservé, sinon l'id stable."""
+    return kept_product_ids.get(old_id) or stable_id("product", old_id)
+
+
+def _hashable(value):
+    """Sérialisation JSON des valeurs non natives : OldRecord comme son dict d'origine."""
+    return value.as_dict() if isinstance(value, OldRecord) else str(value)
+
+
+def row_hash(*rows):
+    """Empreinte stable du contenu d'une ou plusieurs lignes."""
+    payload = json.dumps(rows, sort_keys=True, default=_hashable)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _old_key(key):
+    """Les clés JSON sont des chaînes : restaure les anciens ids numériques."""
+    return int(key) if isinstance(key, str) and key.isdigit() else key
+
+
+def load_state(path=None):
+    """Recharge les mappings old id → new id et les empreintes du run précédent."""
+    path = path or STATE_PATH
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    product_map.update({_old_key(k): v for k, v in state.get("product_map", {}).items()})
+    category_map.update({_old_key(k): v for k, v in state.get("category_map", {}).items()})
+    brand_map.update(state.get("brand_map", {}))
+    product_hashes.update({_old_key(k): v for k, v in state.get("product_hashes", {}).items()})
+    category_hashes.update({_old_key(k): v for k, v in state.get("category_hashes", {}).items()})
+    category_created.update(_old_key(k) for k in state.get("category_created", []))
+    price_hashes.update({_old_key(k): v for k, v in state.get("price_hashes", {}).items()})
+    return state
+
+
+def save_state(path=None, **extra):
+    """Écrit l'état de façon atomique (fichier temporaire puis renommage)."""
+    path = path or STATE_PATH
+    state = {
+        "product_map": product_map,
+        "category_map": category_map,
+        "brand_map": brand_map,
+        "product_hashes": product_hashes,
+        "category_hashes": category_hashes,
+        "category_created": sorted(category_created, key=str),
+        "price_hashes": price_hashes,
+        **extra,
+    }
+    tmp_path = f"{path}.tmp"
+    with state_lock, open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(incremental, staging=False):
+    """
+    Journal de reprise : état courant + phases terminées, références
+    utilisées et stats. Écrit après chaque phase et chaque lot de produits.
+    """
+    save_state(
+        CHECKPOINT_PATH,
+        incremental=incremental,
+        staging=staging,
+        phases_done=phases_done,
+        used_references=sorted(used_references),
+        stats=stats,
+    )
+
+
+def load_checkpoint():
+    """Recharge le journal de reprise. Retourne le mode du run interrompu, ou None."""
+    state = load_state(CHECKPOINT_PATH)
+    if state is None:
+        return None
+    phases_done.extend(state.get("phases_done", []))
+    used_references.update(state.get("used_references", []))
+    stats.update(state.get("stats", {}))
+    return {"incremental": state.get("incremental", False), "staging": state.get("staging", False)}
+
+
+def chunked(items, size):
+    """Découpe une liste en lots de `size` éléments."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def insert_rows(ctx, table, rows, batch_size=None, upsert=False):
+    """
+    Insère des lignes par lots (une requête multi-lignes par lot).
+    Si un lot échoue, repli ligne à ligne pour isoler les lignes fautives.
+    Avec `upsert=True`, les lignes portant un `id` existant sont mises à jour.
+    Retourne une liste alignée sur `rows` : la ligne insérée, ou None en cas d'erreur.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    kind = "upsert" if upsert else "insert"
+    inserted = []
+    for batch in chunked(rows, batch_size):
+        if len(batch) > 1:
+            try:
+                with metrics.track(f"new_db.{kind}") as call:
+                    query = ctx.new_sb.table(table)
+                    result = (query.upsert(batch) if upsert else query.insert(batch)).execute()
+                    call["rows"] = len(result.data or [])
+                if result.data and len(result.data) == len(batch):
+                    inserted.extend(result.data)
+                    continue
+            except Exception as e:
+                print(f"  ⚠️  Lot {table} en échec ({len(batch)} lignes), repli ligne à ligne : {e}")
+        for row in batch:
+            try:
+                with metrics.track(f"new_db.{kind}") as call:
+                    query = ctx.new_sb.table(table)
+                    result = (query.upsert(row) if upsert else query.insert(row)).execute()
+                    call["rows"] = len(result.data or [])
+                inserted.append(result.data[0] if result.data else None)
+            except Exception as e:
+                print(f"  ⚠️  Erreur insertion {table}: {e}")
+                inserted.append(None)
+    return inserted
+
+
 # Extensions connues par content-type
 CONTENT_TYPE_EXT = {
     "image/jpeg": "jpg",
@@ -100,314 +764,1474 @@ CONTENT_TYPE_EXT = {
 
 
 # ============================================================
-# Upload d'image : télécharge depuis URL → upload sur Storage
+# Relances HTTP : backoff exponentiel + gigue, respect de Retry-After
 # ============================================================
-def upload_image_to_storage(image_url, bucket, storage_path):
-    """
-    Télécharge une image depuis une URL externe et l'uploade sur Supabase Storage.
-    Retourne l'URL publique ou None en cas d'erreur.
-    """
-    if not image_url:
+# 408 / 425 / 429 et 5xx de passerelle : l'appel a des chances de réussir plus tard.
+# Les autres 4xx (404, 403...) sont définitifs et ne sont pas relancés.
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+_retry_random = random.Random()
+
+
+def http_status(error):
+    """Statut HTTP porté par une exception requests / storage, None si erreur réseau."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None and error.args and isinstance(error.args[0], dict):
+        # storage3 : StorageException({"statusCode": ..., "error": ..., "message": ...})
+        status = error.args[0].get("statusCode")
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
         return None
 
-    # Corriger les URLs protocol-relative (//)
-    if image_url.startswith("//"):
-        image_url = "https:" + image_url
-    elif not image_url.startswith("http"):
-        return None
 
+def retry_after(error):
+    """Délai (secondes) demandé par l'en-tête Retry-After, None s'il est absent."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        response = requests.get(image_url, timeout=30)
-        response.raise_for_status()
-        file_bytes = response.content
-        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
-
-        ext = CONTENT_TYPE_EXT.get(content_type)
-        if not ext:
-            parsed = urlparse(image_url)
-            path_ext = os.path.splitext(parsed.path)[1].lstrip(".")
-            ext = path_ext if path_ext in ("jpg", "jpeg", "png", "webp", "avif", "gif", "svg") else "jpg"
-        if not content_type:
-            content_type = "image/jpeg"
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
 
-        url_hash = hashlib.md5(image_url.encode()).hexdigest()[:8]
-        timestamp = int(time.time())
-        filename = f"{timestamp}-{url_hash}.{ext}"
-        full_path = f"{storage_path}/{filename}"
 
-        new_sb.storage.from_(bucket).upload(
-            full_path,
-            file_bytes,
-            file_options={"content-type": content_type, "cache-control": "3600", "upsert": "true"},
-        )
+def is_transient(error):
+    if isinstance(error, ImageTooLargeError):
+        return False
+    status = http_status(error)
+    return status is None or status in RETRY_STATUSES
 
-        public_url = new_sb.storage.from_(bucket).get_public_url(full_path)
-        return public_url
 
-    except requests.RequestException as e:
-        print(f"    ⚠️  Erreur téléchargement image: {e}")
-        return None
-    except Exception as e:
-        print(f"    ⚠️  Erreur upload storage: {e}")
-        return None
+def backoff_delay(attempt, error):
+    """
+    Attente avant la tentative `attempt + 1` : Retry-After s'il est fourni,
+    sinon backoff exponentiel avec gigue complète (full jitter), plafonnés
+    à HTTP_BACKOFF_MAX.
+    """
+    delay = retry_after(error)
+    if delay is None:
+        delay = _retry_random.uniform(0, HTTP_BACKOFF * (2 ** attempt))
+    return min(delay, HTTP_BACKOFF_MAX)
+
+
+def with_retries(func, *args):
+    """
+    Appelle `func(*args)` en relançant jusqu'à HTTP_RETRIES fois sur erreur
+    transitoire (réseau, 429, 5xx). La dernière erreur est propagée.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt >= HTTP_RETRIES or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt, e)
+            attempt += 1
+            count("http_retries")
+            log_row(f"    ↻ Relance {attempt}/{HTTP_RETRIES} dans {delay:.1f} s : {e}")
+            time.sleep(delay)
 
 
 # ============================================================
-# 1. Récupérer les données de l'ancien projet (pagination)
+# Upload d'image : télécharge depuis URL → upload sur Storage
 # ============================================================
-def fetch_all_rows(client, table_name):
-    """Récupère toutes les lignes d'une table avec pagination (max 1000 par requête)."""
-    all_rows = []
-    offset = 0
-    page_size = 1000
-    while True:
-        batch = (
-            client.table(table_name)
-            .select("*")
-            .order("id")
-            .range(offset, offset + page_size - 1)
-            .execute()
-            .data
-        )
-        if not batch:
-            break
-        all_rows.extend(batch)
-        if len(batch) < page_size:
-            break
-        offset += page_size
-    return all_rows
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
 
 
-def fetch_old_data():
-    print("\n📥 Récupération des données depuis l'ancien projet...")
+def host_slot(url):
+    """Sémaphore limitant le nombre de connexions simultanées vers un même hôte."""
+    host = urlparse(url).netloc
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(IMAGE_PER_HOST)
+        return _host_semaphores[host]
 
-    products = fetch_all_rows(old_sb, "product")
-    print(f"  ✅ {len(products)} produits")
 
-    pricing = fetch_all_rows(old_sb, "pricing")
-    print(f"  ✅ {len(pricing)} pricing")
+class ImageCache:
+    """
+    Cache persistant (SQLite) des images déjà stockées :
+    URL source → empreinte SHA-256 → objet Storage, et des vérifications
+    d'URLs sources (statut, taille, date). Partagé entre threads.
 
-    categories = fetch_all_rows(old_sb, "category")
-    print(f"  ✅ {len(categories)} catégories")
+    Les objets et déclinaisons sont rangés par projet cible (`project` : URL
+    du nouveau projet) : un même fichier de cache peut servir plusieurs
+    projets sans qu'une URL publique de l'un soit réutilisée dans l'autre.
+    """
 
-    return products, pricing, categories
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Cache d'une version sans projet cible : impossible de savoir à qui
+        # appartiennent ses objets, il est abandonné (les images sont retransférées)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(stored_object)")]
+        if columns and "project" not in columns:
+            self.conn.executescript("DROP TABLE stored_object; DROP TABLE IF EXISTS rendition_set;")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS url_hash (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stored_object (
+                project TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                path TEXT NOT NULL,
+                public_url TEXT NOT NULL,
+                PRIMARY KEY (project, sha256, bucket)
+            );
+            CREATE TABLE IF NOT EXISTS rendition_set (
+                project TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                spec TEXT NOT NULL,
+                renditions TEXT NOT NULL,
+                PRIMARY KEY (project, sha256, bucket, spec)
+            );
+            CREATE TABLE IF NOT EXISTS url_check (
+                url TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                size INTEGER,
+                content_type TEXT,
+                checked_at REAL NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def owned(public_url, project):
+        """Une URL publique n'est réutilisée que si elle pointe sur l'hôte du projet cible."""
+        return urlparse(public_url).netloc == urlparse(project).netloc
+
+    def lookup_url(self, url, project, bucket):
+        """URL publique déjà connue pour cette URL source dans ce bucket du projet, sinon None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT o.public_url FROM url_hash u JOIN stored_object o"
+                " ON o.sha256 = u.sha256 AND o.project = ? AND o.bucket = ? WHERE u.url = ?",
+                (project, bucket, url),
+            ).fetchone()
+        return row[0] if row and self.owned(row[0], project) else None
+
+    def lookup_hash(self, sha256, project, bucket):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT public_url FROM stored_object WHERE project = ? AND sha256 = ? AND bucket = ?",
+                (project, sha256, bucket),
+            ).fetchone()
+        return row[0] if row and self.owned(row[0], project) else None
+
+    def lookup_renditions(self, project, bucket, spec, sha256=None, url=None):
+        """Déclinaisons déjà générées pour ce contenu (par empreinte ou URL source)."""
+        with self.lock:
+            if sha256 is None:
+                row = self.conn.execute("SELECT sha256 FROM url_hash WHERE url = ?", (url,)).fetchone()
+                sha256 = row[0] if row else None
+            row = self.conn.execute(
+                "SELECT renditions FROM rendition_set WHERE project = ? AND sha256 = ? AND bucket = ? AND spec = ?",
+                (project, sha256, bucket, spec),
+            ).fetchone()
+        renditions = json.loads(row[0]) if row else None
+        if renditions and not all(self.owned(r["url"], project) for r in renditions.values()):
+            return None
+        return renditions
+
+    def remember_renditions(self, sha256, project, bucket, spec, renditions):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rendition_set (project, sha256, bucket, spec, renditions)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (project, sha256, bucket, spec, json.dumps(renditions)),
+            )
+            self.conn.commit()
+
+    def remember_url(self, url, sha256):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO url_hash (url, sha256) VALUES (?, ?)", (url, sha256))
+            self.conn.commit()
+
+    def lookup_checks(self, urls, max_age):
+        """Vérifications datant de moins de `max_age` secondes : {url: (statut, taille, content-type)}."""
+        since = time.time() - max_age
+        found = {}
+        with self.lock:
+            for batch in chunked(sorted(urls), 500):
+                rows = self.conn.execute(
+                    "SELECT url, status, size, content_type FROM url_check"
+                    f" WHERE checked_at >= ? AND url IN ({', '.join('?' * len(batch))})",
+                    (since, *batch),
+                ).fetchall()
+                found.update({url: (status, size, content_type) for url, status, size, content_type in rows})
+        return found
+
+    def remember_checks(self, checks):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO url_check (url, status, size, content_type, checked_at) VALUES (?, ?, ?, ?, ?)",
+                [(url, status, size, content_type, now) for url, (status, size, content_type) in checks.items()],
+            )
+            self.conn.commit()
+
+    def forget_objects(self, project, bucket, paths):
+        """Oublie des objets supprimés du bucket : originaux et jeux de déclinaisons qui les contiennent."""
+        with self.lock:
+            for path in paths:
+                if not path.startswith(f"{CONTENT_FOLDER}/"):
+                    continue
+                sha256 = os.path.basename(path).split(".")[0]
+                self.conn.execute(
+                    "DELETE FROM stored_object WHERE project = ? AND sha256 = ? AND bucket = ? AND path = ?",
+                    (project, sha256, bucket, path),
+                )
+                self.conn.execute(
+                    "DELETE FROM rendition_set WHERE project = ? AND sha256 = ? AND bucket = ?"
+                    " AND instr(renditions, ?) > 0",
+                    (project, sha256, bucket, path),
+                )
+            self.conn.commit()
+
+    def remember_object(self, sha256, project, bucket, path, public_url):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stored_object (project, sha256, bucket, path, public_url)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (project, sha256, bucket, path, public_url),
+            )
+            self.conn.commit()
 
 
-# ============================================================
-# 2. Nettoyer TOUTES les données migrées du nouveau projet
-# ============================================================
-def clean_existing_data():
-    print("\n🧹 Suppression des données existantes...")
+_image_cache = None
+_url_locks = {}
+_url_locks_lock = threading.Lock()
 
-    # 1. Tables de jonction et dépendantes (enfants d'abord)
-    junction_tables = [
-        "product_variant_filters_junction",
-        "product_variants",
-        "product_documents",
-        "cart_items",
-        "product_images",
-        "product_specialties",
-        "product_categories",
-    ]
-    for table in junction_tables:
-        try:
-            new_sb.table(table).delete().neq("id", "00000000-0000-0000-0000-000000000000").execute()
-        except Exception as e:
-            print(f"  ⚠️  Erreur nettoyage {table}: {e}")
 
-    # 2. Supprimer tous les produits (garder ceux liés à des commandes existantes)
-    try:
-        referenced = new_sb.table("order_items").select("product_id").execute().data
-        referenced_ids = set(r["product_id"] for r in referenced) if referenced else set()
-    except Exception:
-        referenced_ids = set()
+def get_image_cache():
+    """Ouvre le cache d'images à la première utilisation."""
+    global _image_cache
+    with _url_locks_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(IMAGE_CACHE_PATH)
+        return _image_cache
 
-    all_products = new_sb.table("products").select("id").execute().data or []
-    to_delete = [p["id"] for p in all_products if p["id"] not in referenced_ids]
-    for pid in to_delete:
-        new_sb.table("products").delete().eq("id", pid).execute()
-    print(f"  ✅ {len(to_delete)} produits supprimés")
 
-    # 3. Catégories (liaisons d'abord, puis catégories)
-    try:
-        new_sb.table("category_specialties").delete().neq("category_id", "00000000-0000-0000-0000-000000000000").execute()
-        # Aussi nettoyer category_it_types si existe
-        new_sb.table("category_it_types").delete().neq("category_id", "00000000-0000-0000-0000-000000000000").execute()
-    except Exception:
-        pass
-    try:
-        new_sb.table("categories").delete().neq("id", "00000000-0000-0000-0000-000000000000").execute()
-        print("  ✅ Catégories nettoyées")
-    except Exception as e:
-        print(f"  ⚠️  Erreur nettoyage catégories: {e}")
+def url_lock(url):
+    """Verrou par URL : une même image n'est téléchargée qu'une fois même en parallèle."""
+    with _url_locks_lock:
+        if url not in _url_locks:
+            _url_locks[url] = threading.Lock()
+        return _url_locks[url]
 
-    # 4. Marques
-    try:
-        new_sb.table("brands").delete().neq("id", "00000000-0000-0000-0000-000000000000").execute()
-        print("  ✅ Marques nettoyées")
-    except Exception as e:
-        print(f"  ⚠️  Erreur nettoyage marques: {e}")
 
-    # 5. Vider les buckets storage (images uploadées précédemment)
-    for bucket in ["product-images", "category-images"]:
-        try:
-            files = new_sb.storage.from_(bucket).list()
-            if files:
-                # Lister récursivement les dossiers
-                for folder in files:
-                    folder_name = folder.get("name") if isinstance(folder, dict) else str(folder)
-                    try:
-                        sub_files = new_sb.storage.from_(bucket).list(folder_name)
-                        if sub_files:
-                            paths = [f"{folder_name}/{f['name']}" for f in sub_files if isinstance(f, dict) and f.get("name")]
-                            if paths:
-                                new_sb.storage.from_(bucket).remove(paths)
-                    except Exception:
-                        pass
-            print(f"  ✅ Bucket {bucket} nettoyé")
-        except Exception as e:
-            print(f"  ⚠️  Erreur nettoyage bucket {bucket}: {e}")
+IMAGE_CHUNK_BYTES = 64 * 1024
 
 
-# ============================================================
-# 3. Migrer les catégories (avec upload d'images)
-# ============================================================
-def migrate_categories(old_categories):
-    print("\n📂 Migration des catégories...")
+class ImageDownloadError(Exception):
+    """Échec du téléchargement d'une image source (réseau, HTTP 4xx/5xx)."""
 
-    existing = new_sb.table("categories").select("id, name").execute().data or []
 
-    for old_cat in old_categories:
-        name = (old_cat.get("name") or "").strip()
-        if not name:
-            continue
+class ImageTooLargeError(Exception):
+    """Image source au-delà de IMAGE_MAX_BYTES (définitif, pas de relance)."""
+
+
+class ImagePayload:
+    """
+    Image reçue en flux, hachée au fil des morceaux. Elle reste en mémoire
+    tant qu'elle ne dépasse pas IMAGE_SPOOL_BYTES, puis bascule dans un
+    fichier temporaire : la mémoire consommée ne dépend plus de la taille
+    des images. `data` est passé tel quel à `storage.upload` (octets, ou
+    chemin du fichier que le client Storage relit en flux).
+    """
 
-        material = (old_cat.get("material_type") or "").lower()
-        if "it" in material or "info" in material:
-            product_type = "it_equipment"
-        elif "mobil" in material or "meuble" in material or "furni" in material:
-            product_type = "furniture"
+    def __init__(self):
+        self.size = 0
+        self.path = None
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+
+    @classmethod
+    def from_bytes(cls, data):
+        payload = cls()
+        payload.write(data)
+        payload.close()
+        return payload
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > IMAGE_MAX_BYTES:
+            raise ImageTooLargeError(f"image > {IMAGE_MAX_BYTES} octets")
+        self._digest.update(chunk)
+        if self._file is None and self.size > IMAGE_SPOOL_BYTES:
+            fd, self.path = tempfile.mkstemp(prefix="migration-image-")
+            self._file = os.fdopen(fd, "wb")
+            self._file.write(self._buffer)
+            self._buffer = None
+        if self._file is not None:
+            self._file.write(chunk)
         else:
-            product_type = "medical_equipment"
+            self._buffer += chunk
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif isinstance(self._buffer, bytearray):
+            self._buffer = bytes(self._buffer)
+
+    @property
+    def data(self):
+        return self.path if self.path else self._buffer
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def discard(self):
+        """Libère le tampon ou supprime le fichier temporaire."""
+        self.close()
+        self._buffer = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+def check_content_length(value):
+    """Rejette une image annoncée trop grande avant d'en lire le corps."""
+    try:
+        length = int(value) if value else None
+    except ValueError:
+        return
+    if length is not None and length > IMAGE_MAX_BYTES:
+        raise ImageTooLargeError(f"Content-Length {length} > {IMAGE_MAX_BYTES} octets")
 
-        # Upload image de catégorie
-        image_url = None
-        old_image = old_cat.get("image")
-        if old_image:
-            safe_name = slugify(name)
-            image_url = upload_image_to_storage(
-                old_image, "category-images", f"categories/{safe_name}"
-            )
-            if image_url:
-                print(f"    🖼️  Image catégorie uploadée")
 
-        match = next((c for c in existing if c["name"].lower() == name.lower()), None)
+def fetch_image(ctx, image_url):
+    """
+    Une tentative de téléchargement en flux. Retourne (ImagePayload,
+    content-type) ; lève sur erreur réseau, HTTP ou taille excessive.
+    """
+    with host_slot(image_url), metrics.track("image.download") as call:
+        response = ctx.http.get(image_url, timeout=30, stream=True)
+        payload = ImagePayload()
+        try:
+            response.raise_for_status()
+            check_content_length(response.headers.get("Content-Length"))
+            for chunk in response.iter_content(IMAGE_CHUNK_BYTES):
+                payload.write(chunk)
+            payload.close()
+        except Exception:
+            payload.discard()
+            raise
+        finally:
+            response.close()
+        call["bytes"] = payload.size
+    return payload, response.headers.get("Content-Type", "")
 
-        if match:
-            category_map[old_cat["id"]] = match["id"]
-            stats["categories_mapped"] += 1
-            if image_url:
-                new_sb.table("categories").update({"image_url": image_url}).eq("id", match["id"]).execute()
-            print(f"  📁 \"{name}\" → mappée ({match['id'][:8]}...)")
-        else:
-            result = new_sb.table("categories").insert({
-                "name": name,
-                "description": old_cat.get("product_family") or None,
-                "image_url": image_url,
-                "product_type": product_type,
-            }).execute()
 
-            if result.data:
-                new_cat = result.data[0]
-                category_map[old_cat["id"]] = new_cat["id"]
-                existing.append(new_cat)
-                stats["categories_created"] += 1
-                print(f"  ✅ \"{name}\" → créée ({new_cat['id'][:8]}...)")
+def download_image(ctx, image_url):
+    """
+    Télécharge une image. Retourne (ImagePayload, content-type, extension) ;
+    l'appelant libère le payload avec `discard()` une fois l'upload fait.
+    """
+    try:
+        payload, content_type = with_retries(fetch_image, ctx, image_url)
+    except Exception as e:
+        raise ImageDownloadError(e) from e
+    content_type = content_type.split(";")[0].strip()
+
+    ext = CONTENT_TYPE_EXT.get(content_type)
+    if not ext:
+        parsed = urlparse(image_url)
+        path_ext = os.path.splitext(parsed.path)[1].lstrip(".")
+        ext = path_ext if path_ext in ("jpg", "jpeg", "png", "webp", "avif", "gif", "svg") else "jpg"
+    if not content_type:
+        content_type = "image/jpeg"
+    return payload, content_type, ext
+
 
-        # Lier les spécialités
-        spec_data = old_cat.get("speciality")
-        if spec_data and old_cat["id"] in category_map:
-            migrate_category_specialties(category_map[old_cat["id"]], spec_data)
+def put_object(ctx, bucket, full_path, payload, file_options):
+    """Une tentative d'upload Storage (upsert : rejouable sans risque)."""
+    with host_slot(ctx.new_url), metrics.track("storage.upload") as call:
+        call["bytes"] = payload.size
+        ctx.new_sb.storage.from_(bucket).upload(full_path, payload.data, file_options=file_options)
+
+
+def store_image(ctx, bucket, full_path, payload, content_type, cache_control="3600"):
+    """Uploade une image téléchargée sur Storage et retourne l'URL publique."""
+    file_options = {"content-type": content_type, "cache-control": cache_control, "upsert": "true"}
+    with_retries(put_object, ctx, bucket, full_path, payload, file_options)
+    return ctx.new_sb.storage.from_(bucket).get_public_url(full_path)
 
 
 # ============================================================
-# 3b. Lier les spécialités aux catégories
+# Déclinaisons d'images (redimensionnement + WebP/AVIF)
 # ============================================================
-def migrate_category_specialties(new_category_id, spec_data):
-    existing_specs = new_sb.table("specialties").select("id, name").execute().data or []
-    existing_links = (
-        new_sb.table("category_specialties")
-        .select("specialty_id")
-        .eq("category_id", new_category_id)
-        .execute().data or []
-    )
-    linked_ids = set(l["specialty_id"] for l in existing_links)
-
-    if isinstance(spec_data, str):
-        try:
-            spec_data = json.loads(spec_data)
-        except Exception:
-            return
+_rendition_pool = None
+_rendition_pool_lock = threading.Lock()
 
-    specs = spec_data if isinstance(spec_data, list) else [spec_data]
 
-    for spec in specs:
-        if isinstance(spec, dict):
-            spec_name = (spec.get("name") or spec.get("label") or "").strip()
-        else:
-            spec_name = str(spec).strip()
-        if not spec_name:
-            continue
+def rendition_spec():
+    """Signature des réglages : un changement de tailles ou de format régénère tout."""
+    sizes = ",".join(f"{name}:{size}" for name, size in RENDITIONS)
+    return f"{RENDITION_FORMAT}:{RENDITION_QUALITY}:{sizes}"
 
-        match = next((s for s in existing_specs if s["name"].lower() == spec_name.lower()), None)
 
-        if not match:
-            res = new_sb.table("specialties").insert({"name": spec_name}).execute()
-            if res.data:
-                match = res.data[0]
-                existing_specs.append(match)
+def rendition_config_error():
+    """
+    Message d'erreur si MIGRATION_RENDITIONS est mal formé, ou si les
+    déclinaisons sont demandées sans Pillow ou dans un format que
+    l'installation ne sait pas encoder, sinon None.
+    """
+    try:
+        parse_renditions(RENDITIONS_SETTING)
+    except ValueError as e:
+        return f"MIGRATION_RENDITIONS mal formé ({e}), attendu nom:côté_max,... ex. thumb:200,card:600"
+    if not RENDITIONS:
+        return None
+    if RENDITION_FORMAT not in ("webp", "avif"):
+        return f"MIGRATION_RENDITION_FORMAT inconnu : {RENDITION_FORMAT} (webp ou avif)"
+    try:
+        from PIL import Image
+    except ImportError:
+        return "MIGRATION_RENDITIONS nécessite Pillow (pip install Pillow) !"
+    load_avif_plugin(RENDITION_FORMAT)
+    Image.init()
+    if RENDITION_FORMAT.upper() not in Image.SAVE:
+        hint = " (Pillow >= 11.3 ou pip install pillow-avif-plugin)" if RENDITION_FORMAT == "avif" else ""
+        return f"Pillow ne sait pas encoder le format {RENDITION_FORMAT}{hint} !"
+    return None
+
+
+def load_avif_plugin(fmt):
+    """Encodeur AVIF de pillow-avif-plugin, pour les Pillow < 11.3 qui n'en ont pas."""
+    if fmt == "avif":
+        try:
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            pass
 
-        if match and match["id"] not in linked_ids:
-            new_sb.table("category_specialties").insert({
-                "category_id": new_category_id,
-                "specialty_id": match["id"],
-            }).execute()
-            linked_ids.add(match["id"])
 
+def is_undecodable_image(error):
+    """Erreur de décodage de l'image elle-même (format inconnu, image géante) : définitive."""
+    from PIL import Image, UnidentifiedImageError
+    return isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError))
 
-# ============================================================
-# 4. Migrer les marques
-# ============================================================
-def migrate_brands(old_products):
-    print("\n🏷️  Migration des marques...")
 
-    existing = new_sb.table("brands").select("id, name").execute().data or []
-    unique_brands = sorted(set(
-        p["brand"].strip()
-        for p in old_products
-        if p.get("brand") and p["brand"].strip()
-    ))
+def get_rendition_pool():
+    """Pool de processus d'encodage, créé à la première image."""
+    global _rendition_pool
+    with _rendition_pool_lock:
+        if _rendition_pool is None:
+            _rendition_pool = ProcessPoolExecutor(max_workers=RENDITION_WORKERS)
+        return _rendition_pool
 
-    for brand_name in unique_brands:
-        match = next((b for b in existing if b["name"].lower() == brand_name.lower()), None)
 
-        if match:
-            brand_map[brand_name.lower()] = match["id"]
-            stats["brands_mapped"] += 1
-            print(f"  🏷️  \"{brand_name}\" → mappée ({match['id'][:8]}...)")
-        else:
-            result = new_sb.table("brands").insert({"name": brand_name}).execute()
-            if result.data:
-                new_brand = result.data[0]
-                brand_map[brand_name.lower()] = new_brand["id"]
-                existing.append(new_brand)
-                stats["brands_created"] += 1
-                print(f"  ✅ \"{brand_name}\" → créée ({new_brand['id'][:8]}...)")
+def shutdown_rendition_pool():
+    global _rendition_pool
+    with _rendition_pool_lock:
+        if _rendition_pool is not None:
+            _rendition_pool.shutdown()
+            _rendition_pool = None
 
 
-# ============================================================
+def render_image(source, sizes, fmt, quality):
+    """
+    Exécutée dans un processus du pool (CPU) : décode l'image (octets ou
+    chemin de fichier) et l'encode à chaque côté max demandé, sans jamais
+    l'agrandir. Retourne [(nom, largeur, hauteur, octets), ...].
+    """
+    from io import BytesIO
+    from PIL import Image, ImageOps
+
+    load_avif_plugin(fmt)
+
+    with Image.open(source if isinstance(source, str) else BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image)
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        renditions = []
+        for name, size in sizes:
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            buffer = BytesIO()
+            resized.save(buffer, format=fmt.upper(), quality=quality)
+            renditions.append((name, resized.width, resized.height, buffer.getvalue()))
+    return renditions
+
+
+def make_renditions(ctx, payload, bucket, base_path, cache_control="3600"):
+    """
+    Génère et uploade les déclinaisons d'une image téléchargée.
+    Retourne {nom: {"url", "width", "height"}} (colonne `renditions`) ;
+    {} si l'image ne peut pas être décodée (SVG...), ce qui est définitif ;
+    None si l'encodage (encodeur absent...) ou un upload a échoué, à
+    retenter au prochain run sans rien mettre en cache.
+    Dans les deux cas, l'original reste utilisé.
+    """
+    try:
+        with metrics.track("image.render") as call:
+            future = get_rendition_pool().submit(
+                render_image, payload.data, RENDITIONS, RENDITION_FORMAT, RENDITION_QUALITY
+            )
+            encoded = future.result()
+            call["bytes"] = sum(len(data) for _, _, _, data in encoded)
+    except BrokenExecutor as e:
+        print(f"    ⚠️  Pool d'encodage indisponible ({base_path}): {e}")
+        return None
+    except Exception as e:
+        if is_undecodable_image(e):
+            print(f"    ⚠️  Image non décodable, pas de déclinaisons ({base_path}): {e}")
+            return {}
+        print(f"    ⚠️  Encodage des déclinaisons en échec ({base_path}): {e}")
+        return None
+
+    renditions = {}
+    try:
+        for name, width, height, data in encoded:
+            full_path = f"{base_path}.{name}.{RENDITION_FORMAT}"
+            url = store_image(
+                ctx, bucket, full_path, ImagePayload.from_bytes(data), f"image/{RENDITION_FORMAT}", cache_control
+            )
+            renditions[name] = {"url": url, "width": width, "height": height}
+    except Exception as e:
+        # Les déclinaisons déjà uploadées sont orphelines : le ramasse-miettes s'en charge
+        print(f"    ⚠️  Upload des déclinaisons en échec ({base_path}): {e}")
+        return None
+    return renditions
+
+
+def image_columns(image_url, renditions):
+    """Colonnes image d'une ligne ; `renditions` seulement si l'étape est activée (NULL si aucune)."""
+    columns = {"image_url": image_url}
+    if RENDITIONS:
+        columns["renditions"] = renditions or None
+    return columns
+
+
+def normalize_image_url(image_url):
+    """URL source téléchargeable (protocol-relative corrigée), None si inutilisable."""
+    if not image_url:
+        return None
+    # Corriger les URLs protocol-relative (//)
+    if image_url.startswith("//"):
+        return "https:" + image_url
+    return image_url if image_url.startswith("http") else None
+
+
+def upload_image_to_storage(ctx, image_url, bucket, storage_path):
+    """
+    Télécharge une image depuis une URL externe et l'uploade sur Supabase Storage.
+    Retourne (URL publique, déclinaisons) ; (None, None) en cas d'erreur,
+    déclinaisons None si MIGRATION_RENDITIONS est vide.
+    """
+    image_url = normalize_image_url(image_url)
+    if not image_url:
+        return None, None
+
+    try:
+        if DEDUP_IMAGES:
+            return upload_image_deduplicated(ctx, image_url, bucket)
+
+        payload, content_type, ext = download_image(ctx, image_url)
+
+        url_hash = hashlib.md5(image_url.encode()).hexdigest()[:8]
+        timestamp = int(time.time())
+        base_path = f"{storage_path}/{timestamp}-{url_hash}"
+
+        try:
+            public_url = store_image(ctx, bucket, f"{base_path}.{ext}", payload, content_type)
+            renditions = make_renditions(ctx, payload, bucket, base_path) if RENDITIONS else None
+            return public_url, renditions
+        finally:
+            payload.discard()
+
+    except ImageDownloadError as e:
+        print(f"    ⚠️  Erreur téléchargement image: {e}")
+        return None, None
+    except Exception as e:
+        print(f"    ⚠️  Erreur upload storage: {e}")
+        return None, None
+
+
+def upload_image_deduplicated(ctx, image_url, bucket):
+    """
+    Mode adressé par contenu : l'image est stockée une seule fois sous
+    `sha256/<xx>/<empreinte>.<ext>` (déclinaisons : `<empreinte>.<nom>.<format>`)
+    et son URL publique est réutilisée par tous les produits (et toutes les
+    relances) qui la référencent. Retourne (URL publique, déclinaisons).
+    """
+    cache = get_image_cache()
+    spec = rendition_spec()
+    with url_lock(image_url):
+        public_url = cache.lookup_url(image_url, ctx.new_url, bucket)
+        renditions = cache.lookup_renditions(ctx.new_url, bucket, spec, url=image_url) if RENDITIONS else None
+        # {} : image sans déclinaisons possibles, inutile de la retélécharger
+        if public_url and (renditions is not None or not RENDITIONS):
+            count("images_reused")
+            return public_url, renditions
+
+        payload, content_type, ext = download_image(ctx, image_url)
+        try:
+            sha256 = payload.sha256
+            cache.remember_url(image_url, sha256)
+            base_path = f"{CONTENT_FOLDER}/{sha256[:2]}/{sha256}"
+
+            public_url = cache.lookup_hash(sha256, ctx.new_url, bucket)
+            if public_url:
+                count("images_reused")
+            else:
+                full_path = f"{base_path}.{ext}"
+                # Contenu immuable : cache navigateur/CDN long
+                public_url = store_image(ctx, bucket, full_path, payload, content_type, cache_control="31536000")
+                cache.remember_object(sha256, ctx.new_url, bucket, full_path, public_url)
+
+            if RENDITIONS:
+                renditions = cache.lookup_renditions(ctx.new_url, bucket, spec, sha256=sha256)
+                if renditions is None:
+                    renditions = make_renditions(ctx, payload, bucket, base_path, cache_control="31536000")
+                    if renditions is not None:
+                        cache.remember_renditions(sha256, ctx.new_url, bucket, spec, renditions)
+        finally:
+            payload.discard()
+        return public_url, renditions
+
+
+def transfer_images(ctx, tasks):
+    """
+    Transfère un lot d'images en parallèle (pool borné à IMAGE_WORKERS).
+    `tasks` : liste de (clé, image_url, bucket, storage_path).
+    Génère les quadruplets (clé, url publique ou None, déclinaisons ou None,
+    ignorée) au fil des fins de transfert. Les URLs reconnues mortes par la
+    pré-vérification sont rendues aussitôt (None, ignorée = True) : rien ne
+    changera au prochain run, contrairement à un transfert en échec. Les plus
+    grosses images partent en premier pour ne pas finir seules en fin de lot.
+    """
+    live = []
+    for task in tasks:
+        check = url_checks.get(normalize_image_url(task[1]))
+        if check and is_dead_url(check):
+            count("images_skipped")
+            yield task[0], None, None, True
+        else:
+            live.append(task)
+    tasks = sorted(live, key=lambda t: -(url_checks.get(normalize_image_url(t[1]), (0, 0, ""))[1] or 0))
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=min(IMAGE_WORKERS, len(tasks))) as pool:
+        futures = {
+            pool.submit(upload_image_to_storage, ctx, image_url, bucket, storage_path): key
+            for key, image_url, bucket, storage_path in tasks
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            progress("images", done, len(futures))
+            yield (futures[future], *future.result(), False)
+
+
+# ============================================================
+# Pré-vérification des URLs d'images sources (cache négatif)
+# ============================================================
+def content_range_total(value):
+    """Taille totale annoncée par un Content-Range (`bytes 0-0/12345`), None si absente."""
+    total = (value or "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def probe_url(ctx, url):
+    """
+    Vérifie une URL source sans télécharger l'image : HEAD, repli sur un GET
+    d'un seul octet (Range) si le serveur refuse HEAD. Les erreurs
+    transitoires (réseau, 429, 5xx) sont relancées comme un téléchargement.
+    Retourne (statut HTTP, 0 si injoignable ou trop lent ; taille ou None ;
+    content-type).
+    """
+    def head():
+        with host_slot(url), metrics.track("image.head"):
+            response = ctx.http.head(url, timeout=PREFLIGHT_TIMEOUT, allow_redirects=True)
+            if response.status_code in (403, 405, 501):
+                response = ctx.http.get(url, timeout=PREFLIGHT_TIMEOUT, stream=True, headers={"Range": "bytes=0-0"})
+                response.close()
+        if response.status_code in RETRY_STATUSES:
+            response.raise_for_status()
+        return response
+
+    try:
+        response = with_retries(head)
+    except Exception as e:
+        return http_status(e) or 0, None, ""
+    headers = response.headers
+    length = headers.get("Content-Length") or ""
+    size = content_range_total(headers.get("Content-Range")) or (int(length) if length.isdigit() else None)
+    return response.status_code, size or None, headers.get("Content-Type", "").split(";")[0].strip()
+
+
+def is_definitive_check(check):
+    """Réponse qui ne changera pas d'un essai à l'autre : ni injoignable (0), ni 429 / 5xx."""
+    return check[0] != 0 and check[0] not in RETRY_STATUSES
+
+
+def is_dead_url(check):
+    """
+    URL à ne pas télécharger : erreur client définitive (404, 410...) ou image
+    annoncée au-delà de IMAGE_MAX_BYTES. Les URLs injoignables ou en erreur
+    transitoire (429, 5xx) restent tentées au transfert, avec relances.
+    """
+    status, size, _ = check
+    if 400 <= status < 500 and status not in RETRY_STATUSES:
+        return True
+    return bool(size and size > IMAGE_MAX_BYTES)
+
+
+def preflight_images(ctx, products, categories):
+    """
+    Vérifie en parallèle les URLs distinctes des images de produits et de
+    catégories qui seront téléchargées (hors images déjà stockées en mode
+    dédupliqué). Les réponses définitives de moins de URL_CHECK_TTL sont
+    reprises du cache, les nouvelles y sont enregistrées ; les échecs
+    transitoires ne sont pas mis en cache et seront revérifiés au prochain
+    run. `transfer_images` s'en sert ensuite.
+    """
+    print("\n🔎 Pré-vérification des URLs d'images...")
+    cache = get_image_cache()
+    pairs = set()
+    for bucket, rows in (("product-images", products), ("category-images", categories)):
+        for row in rows:
+            url = normalize_image_url(row.get("image"))
+            if url:
+                pairs.add((bucket, url))
+    pending = set(
+        url for bucket, url in pairs if not (DEDUP_IMAGES and cache.lookup_url(url, ctx.new_url, bucket))
+    )
+
+    known = {
+        url: check for url, check in cache.lookup_checks(pending, URL_CHECK_TTL).items()
+        if is_definitive_check(check)
+    }
+    to_probe = sorted(pending - set(known))
+    probed = {}
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        for done, (url, check) in enumerate(zip(to_probe, pool.map(lambda u: probe_url(ctx, u), to_probe)), start=1):
+            probed[url] = check
+            progress("URLs vérifiées", done, len(to_probe))
+    cache.remember_checks({url: check for url, check in probed.items() if is_definitive_check(check)})
+
+    url_checks.update(known)
+    url_checks.update(probed)
+    dead = sum(1 for url in pending if is_dead_url(url_checks[url]))
+    unsure = sum(1 for check in probed.values() if not is_definitive_check(check))
+    stats["image_urls_checked"] += len(probed)
+    stats["image_urls_dead"] = dead
+    print(f"  ✅ {len(pending)} URLs à transférer : {len(probed)} vérifiées, {len(known)} en cache, "
+          f"{dead} mortes ou trop grosses (ignorées), {unsure} sans réponse (tentées quand même)")
+
+
+# ============================================================
+# 1. Récupérer les données de l'ancien projet (pagination)
+# ============================================================
+# Colonnes réellement utilisées par la migration (projection au lieu de select("*"))
+OLD_COLUMNS = {
+    "product": (
+        "id, name, serial_number, description, provider_price, pricing, brand, product_type, "
+        "filter_color, filter_processor, filter_storage, filter_screenSize, product_family, "
+        "product_group_uid, is_cheapest_in_group, technicals_informations, created_at, image, "
+        "category, speciality"
+    ),
+    "pricing": "id, marlon_margin, provider_price",
+    "category": "id, name, material_type, image, product_family, speciality",
+}
+
+# Colonnes de faible cardinalité, répétées d'une ligne à l'autre : une seule
+# copie de chaque valeur (sys.intern)
+INTERNED_COLUMNS = {
+    "brand", "product_type", "speciality", "material_type", "product_family", "product_group_uid",
+    "filter_color", "filter_processor", "filter_storage", "filter_screenSize",
+}
+
+
+class OldRecord:
+    """
+    Ligne compacte de l'ancien projet : uniquement les colonnes de la
+    projection (OLD_COLUMNS), en slots plutôt qu'en dict, valeurs répétitives
+    internées. Se lit comme le dict d'origine (`row["id"]`, `row.get(...)`)
+    et s'empreinte à l'identique (`row_hash`).
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    FIELD_SET = frozenset()
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls.__new__(cls)
+        for field in cls.FIELDS:
+            value = row.get(field)
+            if type(value) is str and field in INTERNED_COLUMNS:
+                value = sys.intern(value)
+            setattr(record, field, value)
+        return record
+
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.FIELD_SET
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELD_SET else default
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()!r})"
+
+
+def record_class(table, columns):
+    """Classe OldRecord à slots pour les colonnes d'une table de l'ancien projet."""
+    fields = tuple(c.strip() for c in columns.split(","))
+    return type(f"Old{table.capitalize()}", (OldRecord,), {
+        "__slots__": fields,
+        "FIELDS": fields,
+        "FIELD_SET": frozenset(fields),
+    })
+
+
+OLD_RECORDS = {table: record_class(table, columns) for table, columns in OLD_COLUMNS.items()}
+
+PAGE_SIZE = 1000  # max PostgREST par requête
+
+
+def iter_pages(client, table_name, columns="*", page_size=PAGE_SIZE, source="new_db"):
+    """
+    Génère les pages d'une table par pagination keyset sur `id`
+    (`id > dernier id vu`) : coût constant par page, contrairement à OFFSET.
+    """
+    if columns != "*" and "id" not in [c.strip() for c in columns.split(",")]:
+        columns = f"{columns}, id"
+    kind = f"{source}.select"
+    last_id = None
+    while True:
+        query = client.table(table_name).select(columns).order("id").limit(page_size)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        with metrics.track(kind) as call:
+            page = query.execute().data
+            call["rows"] = len(page or [])
+        if not page:
+            break
+        yield page
+        if len(page) < page_size:
+            break
+        last_id = page[-1]["id"]
+
+
+def fetch_all_rows(client, table_name, columns="*", source="new_db"):
+    """Récupère toutes les lignes d'une table avec pagination (max 1000 par requête)."""
+    all_rows = []
+    for page in iter_pages(client, table_name, columns, source=source):
+        all_rows.extend(page)
+    return all_rows
+
+
+def fetch_old_table(ctx, table_name):
+    """
+    Récupère une table de l'ancien projet avec sa projection (repli sur * si
+    une colonne manque), page par page, en OldRecord compacts.
+    """
+    record = OLD_RECORDS[table_name].from_row
+    try:
+        pages = iter_pages(ctx.old_sb, table_name, OLD_COLUMNS[table_name], source="old_db")
+        return [record(row) for page in pages for row in page]
+    except Exception as e:
+        print(f"  ⚠️  Projection {table_name} refusée ({e}), repli sur select(*)")
+        pages = iter_pages(ctx.old_sb, table_name, source="old_db")
+        return [record(row) for page in pages for row in page]
+
+
+def fetch_old_data(ctx):
+    """Récupère product, pricing et category en parallèle."""
+    print("\n📥 Récupération des données depuis l'ancien projet...")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        products_f = pool.submit(fetch_old_table, ctx, "product")
+        pricing_f = pool.submit(fetch_old_table, ctx, "pricing")
+        categories_f = pool.submit(fetch_old_table, ctx, "category")
+        products, pricing, categories = products_f.result(), pricing_f.result(), categories_f.result()
+
+    print(f"  ✅ {len(products)} produits")
+    print(f"  ✅ {len(pricing)} pricing")
+    print(f"  ✅ {len(categories)} catégories")
+
+    return products, pricing, categories
+
+
+# ============================================================
+# 2. Nettoyer TOUTES les données migrées du nouveau projet
+# ============================================================
+NIL_UUID = "00000000-0000-0000-0000-000000000000"
+DELETE_CHUNK = 200  # ids par requête `in` (longueur d'URL)
+STORAGE_PAGE = 1000  # objets par page de listing / par appel remove
+
+
+def timed(label, func, *args):
+    """Exécute `func`, affiche et mesure sa durée (`clean.<label>`). Retourne le résultat."""
+    start = time.perf_counter()
+    with metrics.track(f"clean.{label}"):
+        result = func(*args)
+    print(f"  ⏱️  {label} : {time.perf_counter() - start:.1f} s")
+    return result
+
+
+def delete_all(ctx, table, column="id"):
+    """Vide une table en une requête ensembliste. Retourne le nombre de lignes supprimées."""
+    with metrics.track("new_db.delete") as call:
+        result = ctx.new_sb.table(table).delete(count="exact", returning="minimal").neq(column, NIL_UUID).execute()
+        call["rows"] = result.count or 0
+    return result.count or 0
+
+
+def delete_ids(ctx, table, ids):
+    """Supprime des lignes par lots d'ids (`in`), lots envoyés en parallèle."""
+    def delete_chunk(chunk):
+        with metrics.track("new_db.delete") as call:
+            ctx.new_sb.table(table).delete(returning="minimal").in_("id", chunk).execute()
+            call["rows"] = len(chunk)
+        return len(chunk)
+
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        return sum(pool.map(delete_chunk, list(chunked(ids, DELETE_CHUNK))))
+
+
+def delete_unreferenced_products(ctx):
+    """Supprime tous les produits sauf ceux liés à des commandes existantes."""
+    try:
+        referenced_ids = set(r["product_id"] for r in fetch_all_rows(ctx.new_sb, "order_items", "product_id"))
+    except Exception:
+        referenced_ids = set()
+
+    if len(referenced_ids) <= DELETE_CHUNK:
+        # Une seule requête : id NOT IN (produits commandés)
+        query = ctx.new_sb.table("products").delete(count="exact", returning="minimal")
+        if referenced_ids:
+            query = query.not_.in_("id", sorted(referenced_ids))
+        else:
+            query = query.neq("id", NIL_UUID)
+        with metrics.track("new_db.delete") as call:
+            call["rows"] = query.execute().count or 0
+        return call["rows"]
+
+    # Trop d'ids pour une URL : suppression par lots des ids non référencés
+    all_ids = [p["id"] for p in fetch_all_rows(ctx.new_sb, "products", "id")]
+    return delete_ids(ctx, "products", [pid for pid in all_ids if pid not in referenced_ids])
+
+
+def list_storage_entries(ctx, bucket, folder=""):
+    """Liste paginée des entrées (fichiers et dossiers) d'un dossier de bucket."""
+    storage = ctx.new_sb.storage.from_(bucket)
+    entries = []
+    offset = 0
+    while True:
+        with metrics.track("storage.list") as call:
+            page = storage.list(folder, {"limit": STORAGE_PAGE, "offset": offset}) or []
+            call["rows"] = len(page)
+        entries.extend(page)
+        if len(page) < STORAGE_PAGE:
+            break
+        offset += STORAGE_PAGE
+    return entries
+
+
+def remove_storage_files(ctx, bucket, paths):
+    """Supprime des objets par lots de STORAGE_PAGE."""
+    for batch in chunked(paths, STORAGE_PAGE):
+        with metrics.track("storage.remove") as call:
+            ctx.new_sb.storage.from_(bucket).remove(batch)
+            call["rows"] = len(batch)
+    return len(paths)
+
+
+def clean_existing_data(ctx):
+    print("\n🧹 Suppression des données existantes...")
+
+    # 1. Tables de jonction et dépendantes (enfants d'abord)
+    junction_tables = [
+        "product_variant_filters_junction",
+        "product_variants",
+        "product_documents",
+        "cart_items",
+        "product_images",
+        "product_specialties",
+        "product_categories",
+    ]
+    for table in junction_tables:
+        try:
+            deleted = timed(table, delete_all, ctx, table)
+            print(f"  ✅ {table} : {deleted} lignes supprimées")
+        except Exception as e:
+            print(f"  ⚠️  Erreur nettoyage {table}: {e}")
+
+    # 2. Supprimer tous les produits (garder ceux liés à des commandes existantes)
+    deleted = timed("products", delete_unreferenced_products, ctx)
+    print(f"  ✅ {deleted} produits supprimés")
+
+    # 3. Catégories (liaisons d'abord, puis catégories)
+    try:
+        timed("category_specialties", delete_all, ctx, "category_specialties", "category_id")
+        # Aussi nettoyer category_it_types si existe
+        timed("category_it_types", delete_all, ctx, "category_it_types", "category_id")
+    except Exception:
+        pass
+    try:
+        timed("categories", delete_all, ctx, "categories")
+        print("  ✅ Catégories nettoyées")
+    except Exception as e:
+        print(f"  ⚠️  Erreur nettoyage catégories: {e}")
+
+    # 4. Marques
+    try:
+        timed("brands", delete_all, ctx, "brands")
+        print("  ✅ Marques nettoyées")
+    except Exception as e:
+        print(f"  ⚠️  Erreur nettoyage marques: {e}")
+
+    # Les index de noms chargés avant le nettoyage ne sont plus valides
+    name_indexes.clear()
+
+    # Les buckets ne sont pas vidés : les images que le nouveau catalogue ne
+    # référence plus sont supprimées en fin de run (collect_storage_garbage)
+
+
+# ============================================================
+# 2b. Mode --staging : chargement dans les tables fantômes, puis bascule
+# ============================================================
+def reset_staging(ctx):
+    """Vide les tables fantômes ; le catalogue en ligne n'est pas touché."""
+    print("\n🧹 Réinitialisation des tables fantômes (le catalogue en ligne reste servi)...")
+    with metrics.track("new_db.rpc"):
+        ctx.live_sb.rpc("reset_catalog_staging", {}).execute()
+    name_indexes.clear()
+
+
+def swap_staging(ctx):
+    """
+    Bascule le catalogue chargé dans les tables fantômes vers les tables en
+    ligne, en une transaction côté serveur (swap_catalog_staging). Les
+    comptes attendus sont vérifiés par la fonction : en cas d'écart, rien
+    n'est modifié.
+    """
+    print("\n🔀 Bascule des tables fantômes vers le catalogue en ligne...")
+    expected = {
+        "brands": len(set(brand_map.values())),
+        "categories": len(set(category_map.values())),
+        "products": len(set(product_map.values())),
+    }
+    if not expected["products"]:
+        raise RuntimeError("aucun produit chargé, bascule annulée (catalogue en ligne inchangé)")
+
+    start = time.perf_counter()
+    try:
+        with metrics.track("new_db.rpc") as call:
+            copied = ctx.live_sb.rpc("swap_catalog_staging", {"expected": expected}).execute().data or {}
+            call["rows"] = sum(copied.values())
+    except Exception as e:
+        print(f"  ❌ Bascule annulée, catalogue en ligne inchangé : {e}")
+        raise
+    print(f"  ✅ Catalogue basculé en {time.perf_counter() - start:.2f} s : "
+          + ", ".join(f"{table} {n}" for table, n in copied.items()))
+
+
+# ============================================================
+# 2c. Ramasse-miettes Storage (réconciliation avec les lignes en base)
+# ============================================================
+IMAGE_BUCKETS = ["product-images", "category-images"]
+
+
+def storage_object_path(public_url, bucket):
+    """Chemin d'objet d'une URL publique de ce bucket, None si l'URL pointe ailleurs."""
+    marker = f"/storage/v1/object/public/{bucket}/"
+    if not public_url or marker not in public_url:
+        return None
+    return unquote(public_url.split(marker, 1)[1].split("?", 1)[0])
+
+
+def storage_entry_age(entry, now):
+    """Âge en secondes d'un objet listé (updated_at, sinon created_at), None si inconnu."""
+    stamp = entry.get("updated_at") or entry.get("created_at")
+    try:
+        return now - datetime.fromisoformat(stamp.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def list_bucket_objects(ctx, bucket, pool):
+    """
+    Tous les objets d'un bucket, {chemin: entrée de listing}. L'arborescence
+    est parcourue niveau par niveau, les dossiers d'un niveau listés en
+    parallèle (chacun paginé).
+    """
+    objects = {}
+    folders = [""]
+    while folders:
+        subfolders = []
+        listings = pool.map(lambda folder: list_storage_entries(ctx, bucket, folder), folders)
+        for folder, entries in zip(folders, listings):
+            for entry in entries:
+                path = f"{folder}/{entry['name']}" if folder else entry["name"]
+                if entry.get("id") is None:  # dossier
+                    subfolders.append(path)
+                else:
+                    objects[path] = entry
+        folders = subfolders
+    return objects
+
+
+def is_missing_column(error, column):
+    """Erreur PostgREST « colonne inexistante » (42703) portant sur `column`."""
+    return getattr(error, "code", None) == "42703" or f"{column} does not exist" in str(error)
+
+
+def referenced_storage_paths(ctx):
+    """
+    Chemins encore référencés, par bucket : image_url et URLs des déclinaisons
+    de product_images et categories (tables en ligne, y compris après une
+    bascule --staging). Sans la colonne `renditions` (migration 017 non
+    appliquée), seul image_url est lu : aucune déclinaison ne peut exister.
+    """
+    referenced = {bucket: set() for bucket in IMAGE_BUCKETS}
+    for table in ("product_images", "categories"):
+        try:
+            rows = fetch_all_rows(ctx.live_sb, table, "image_url, renditions")
+        except Exception as e:
+            if not is_missing_column(e, "renditions"):
+                raise
+            rows = fetch_all_rows(ctx.live_sb, table, "image_url")
+        for row in rows:
+            renditions = row.get("renditions") or {}
+            if isinstance(renditions, str):
+                renditions = json.loads(renditions)
+            urls = [row.get("image_url")] + [r.get("url") for r in renditions.values() if isinstance(r, dict)]
+            for url in urls:
+                for bucket in IMAGE_BUCKETS:
+                    path = storage_object_path(url, bucket)
+                    if path:
+                        referenced[bucket].add(path)
+    return referenced
+
+
+def collect_storage_garbage(ctx):
+    """
+    Supprime des buckets d'images les seuls objets orphelins : ni image_url ni
+    déclinaison d'une ligne ne les référence, et ils ont plus de
+    STORAGE_GC_GRACE. Les objets encore utilisés restent en place (et dans le
+    cache de déduplication) : un nouveau run ne retransfère que ce qui a changé.
+    """
+    print("\n🗑️  Ramasse-miettes Storage (objets non référencés)...")
+    referenced = referenced_storage_paths(ctx)
+    cache = get_image_cache()
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        for bucket in IMAGE_BUCKETS:
+            try:
+                objects = list_bucket_objects(ctx, bucket, pool)
+            except Exception as e:
+                print(f"  ⚠️  Listing du bucket {bucket} impossible, rien n'est supprimé : {e}")
+                continue
+            orphans = []
+            for path, entry in sorted(objects.items()):
+                age = storage_entry_age(entry, now)
+                if path not in referenced[bucket] and (age is None or age >= STORAGE_GC_GRACE):
+                    orphans.append(path)
+
+            # Oubliés d'abord : un objet supprimé ne doit plus être proposé à la réutilisation
+            cache.forget_objects(ctx.new_url, bucket, orphans)
+            batches = list(chunked(orphans, STORAGE_PAGE))
+            removed = sum(pool.map(lambda batch: remove_storage_files(ctx, bucket, batch), batches))
+            stats["storage_orphans_removed"] += removed
+            stats["storage_objects_kept"] += len(objects) - removed
+            print(f"  ✅ Bucket {bucket} : {removed} orphelins supprimés, {len(objects) - removed} objets conservés")
+
+
+# ============================================================
+# Index des noms (catégories, marques, spécialités)
+# ============================================================
+def get_name_index(ctx, table, columns="id, name"):
+    """
+    Index nom normalisé → ligne d'une table du nouveau projet, chargé une
+    seule fois puis tenu à jour par `index_row` à chaque insertion.
+    """
+    with state_lock:
+        if table not in name_indexes:
+            rows = fetch_all_rows(ctx.new_sb, table, columns)
+            name_indexes[table] = {name_key(r["name"]): r for r in rows}
+        return name_indexes[table]
+
+
+def index_row(table, row):
+    """Ajoute une ligne insérée à l'index (déjà chargé) de sa table."""
+    with state_lock:
+        name_indexes[table][name_key(row["name"])] = row
+
+
+def parse_specialties(spec_data):
+    """Extrait la liste des noms de spécialités (JSON, liste, dict ou texte)."""
+    if not spec_data:
+        return []
+    if isinstance(spec_data, str):
+        try:
+            spec_data = json.loads(spec_data)
+        except Exception:
+            return []
+    if not spec_data:
+        return []
+
+    names = []
+    specs = spec_data if isinstance(spec_data, list) else [spec_data]
+    for spec in specs:
+        if isinstance(spec, dict):
+            spec_name = (spec.get("name") or spec.get("label") or "").strip()
+        else:
+            spec_name = str(spec).strip()
+        if spec_name:
+            names.append(spec_name)
+    return names
+
+
+def ensure_specialties(ctx, spec_names):
+    """
+    Crée en une insertion groupée les spécialités absentes de l'index.
+    Sérialisé entre shards : deux shards ne créent jamais la même spécialité.
+    """
+    with state_lock:
+        index = get_name_index(ctx, "specialties")
+        missing = {}
+        for spec_name in spec_names:
+            key = name_key(spec_name)
+            if key not in index and key not in missing:
+                missing[key] = spec_name
+        for row in insert_rows(ctx, "specialties", [{"name": n} for n in missing.values()]):
+            if row:
+                index_row("specialties", row)
+
+
+def ensure_specialty(ctx, spec_name):
+    """Retourne la spécialité de ce nom, en la créant si besoin."""
+    ensure_specialties(ctx, [spec_name])
+    return get_name_index(ctx, "specialties").get(name_key(spec_name))
+
+
+# ============================================================
+# 3. Migrer les catégories (avec upload d'images)
+# ============================================================
+def migrate_categories(ctx, old_categories, incremental=False):
+    print("\n📂 Migration des catégories...")
+
+    # Lignes complètes : l'upsert groupé des images doit renvoyer toutes les colonnes
+    existing = get_name_index(ctx, "categories", "*")
+
+    if incremental:
+        old_categories = select_changed_categories(ctx, old_categories, existing)
+
+    # Upload des images de catégorie en parallèle, avant les écritures
+    image_tasks = [
+        (old_cat["id"], old_cat["image"], "category-images", f"categories/{slugify((old_cat.get('name') or '').strip())}")
+        for old_cat in old_categories
+        if (old_cat.get("name") or "").strip() and old_cat.get("image")
+    ]
+    images = {key: (url, renditions) for key, url, renditions, _ in transfer_images(ctx, image_tasks)}
+    print(f"  🖼️  {sum(1 for u, _ in images.values() if u)}/{len(image_tasks)} images catégorie uploadées")
+    image_updates = []
+    category_specs = []
+
+    for old_cat in old_categories:
+        name = (old_cat.get("name") or "").strip()
+        if not name:
+            continue
+
+        product_type = category_product_type(old_cat)
+
+        image_url, renditions = images.get(old_cat["id"], (None, None))
+
+        match = existing.get(name_key(name))
+
+        if match:
+            category_map[old_cat["id"]] = match["id"]
+            category_hashes[old_cat["id"]] = row_hash(old_cat)
+            stats["categories_mapped"] += 1
+            if image_url:
+                image_updates.append({**match, **image_columns(image_url, renditions)})
+            log_row(f"  📁 \"{name}\" → mappée ({match['id'][:8]}...)")
+        else:
+            with metrics.track("new_db.insert") as call:
+                result = ctx.new_sb.table("categories").insert({
+                    "name": name,
+                    "description": old_cat.get("product_family") or None,
+                    **image_columns(image_url, renditions),
+                    "product_type": product_type,
+                }).execute()
+                call["rows"] = len(result.data or [])
+
+            if result.data:
+                new_cat = result.data[0]
+                category_map[old_cat["id"]] = new_cat["id"]
+                category_hashes[old_cat["id"]] = row_hash(old_cat)
+                category_created.add(old_cat["id"])
+                index_row("categories", new_cat)
+                stats["categories_created"] += 1
+                log_row(f"  ✅ \"{name}\" → créée ({new_cat['id'][:8]}...)")
+
+        # Spécialités : liées en masse après la boucle
+        spec_names = parse_specialties(old_cat.get("speciality"))
+        if spec_names and old_cat["id"] in category_map:
+            category_specs.append((category_map[old_cat["id"]], spec_names))
+
+    migrate_category_specialties(ctx, category_specs)
+
+    # Images des catégories existantes : une seule écriture groupée
+    for batch in chunked(image_updates, BATCH_SIZE):
+        try:
+            with metrics.track("new_db.upsert") as call:
+                result = ctx.new_sb.table("categories").upsert(batch).execute()
+                call["rows"] = len(result.data or [])
+        except Exception as e:
+            print(f"  ⚠️  Erreur mise à jour images catégories: {e}")
+
+
+def select_changed_categories(ctx, old_categories, existing):
+    """
+    Mode incrémental : ne garde que les catégories nouvelles ou modifiées,
+    et supprime les catégories créées par la migration qui n'existent plus.
+    """
+    existing_ids = set(c["id"] for c in existing.values())
+    for old_id, new_id in list(category_map.items()):
+        if new_id not in existing_ids:
+            category_map.pop(old_id)
+            category_hashes.pop(old_id, None)
+            category_created.discard(old_id)
+
+    old_ids = set(c["id"] for c in old_categories)
+    removed = [old_id for old_id in category_map if old_id not in old_ids]
+    to_delete = [category_map[old_id] for old_id in removed if old_id in category_created]
+    for batch in chunked(to_delete, BATCH_SIZE):
+        try:
+            with metrics.track("new_db.delete") as call:
+                ctx.new_sb.table("categories").delete(returning="minimal").in_("id", batch).execute()
+                call["rows"] = len(batch)
+            stats["categories_deleted"] += len(batch)
+        except Exception as e:
+            print(f"  ⚠️  Erreur suppression catégories: {e}")
+    deleted_ids = set(to_delete)
+    for key in [k for k, c in existing.items() if c["id"] in deleted_ids]:
+        existing.pop(key)
+    for old_id in removed:
+        category_map.pop(old_id)
+        category_hashes.pop(old_id, None)
+        category_created.discard(old_id)
+
+    changed = [
+        c for c in old_categories
+        if not (c["id"] in category_map and category_hashes.get(c["id"]) == row_hash(c))
+    ]
+    stats["categories_unchanged"] += len(old_categories) - len(changed)
+    print(f"  🔄 {len(changed)} nouvelles/modifiées, {len(removed)} disparues, {stats['categories_unchanged']} inchangées")
+    return changed
+
+
+# ============================================================
+# 3b. Lier les spécialités aux catégories
+# ============================================================
+def migrate_category_specialties(ctx, category_specs):
+    """
+    Lie les spécialités aux catégories en un nombre constant de requêtes :
+    liens existants chargés une fois, spécialités manquantes puis liens
+    manquants insérés chacun en une écriture groupée.
+    `category_specs` : liste de (id nouvelle catégorie, noms de spécialités).
+    """
+    if not category_specs:
+        return
+
+    existing_links = fetch_all_rows(ctx.new_sb, "category_specialties", "category_id, specialty_id")
+    linked = set((l["category_id"], l["specialty_id"]) for l in existing_links)
+
+    ensure_specialties(ctx, [name for _, spec_names in category_specs for name in spec_names])
+    index = get_name_index(ctx, "specialties")
+
+    link_rows = []
+    for new_category_id, spec_names in category_specs:
+        for spec_name in spec_names:
+            match = index.get(name_key(spec_name))
+            if match and (new_category_id, match["id"]) not in linked:
+                linked.add((new_category_id, match["id"]))
+                link_rows.append({
+                    "category_id": new_category_id,
+                    "specialty_id": match["id"],
+                })
+
+    inserted = insert_rows(ctx, "category_specialties", link_rows)
+    print(f"  🏥 {sum(1 for r in inserted if r)} liens catégorie ↔ spécialité créés")
+
+
+# ============================================================
+# 4. Migrer les marques
+# ============================================================
+def migrate_brands(ctx, old_products):
+    print("\n🏷️  Migration des marques...")
+
+    brand_map.clear()  # reconstruit entièrement depuis l'index
+    existing = get_name_index(ctx, "brands")
+    unique_brands = sorted(set(
+        p["brand"].strip()
+        for p in old_products
+        if p.get("brand") and p["brand"].strip()
+    ))
+
+    for brand_name in unique_brands:
+        key = name_key(brand_name)
+        if key in brand_map:
+            continue  # variante d'écriture d'une marque déjà traitée
+        match = existing.get(key)
+
+        if match:
+            brand_map[key] = match["id"]
+            stats["brands_mapped"] += 1
+            log_row(f"  🏷️  \"{brand_name}\" → mappée ({match['id'][:8]}...)")
+        else:
+            with metrics.track("new_db.insert") as call:
+                result = ctx.new_sb.table("brands").insert({"name": brand_name}).execute()
+                call["rows"] = len(result.data or [])
+            if result.data:
+                new_brand = result.data[0]
+                brand_map[key] = new_brand["id"]
+                index_row("brands", new_brand)
+                stats["brands_created"] += 1
+                log_row(f"  ✅ \"{brand_name}\" → créée ({new_brand['id'][:8]}...)")
+
+
+# ============================================================
 # 5. Mapper product_type
 # ============================================================
+def category_product_type(old_cat):
+    """product_type d'une catégorie, déduit de son ancien material_type."""
+    material = (old_cat.get("material_type") or "").lower()
+    if "it" in material or "info" in material:
+        return "it_equipment"
+    if "mobil" in material or "meuble" in material or "furni" in material:
+        return "furniture"
+    return "medical_equipment"
+
+
 def map_product_type(old_type):
     if not old_type:
         return "medical_equipment"
@@ -422,200 +2246,1140 @@ def map_product_type(old_type):
 # ============================================================
 # 6. Migrer les produits (avec upload d'images sur Storage)
 # ============================================================
-def migrate_products(old_products, pricing_data):
-    print("\n📦 Migration des produits...")
-
-    for p in pricing_data:
-        pricing_map[p["id"]] = p
-
-    existing_specs = new_sb.table("specialties").select("id, name").execute().data or []
+def build_product_row(old_p):
+    """
+    Construit la ligne `products` du nouveau schéma à partir d'un ancien produit.
+    `parent_product_id` n'y figure pas : il est posé après coup par `link_variants`.
+    """
+    old_id = old_p["id"]
+
+    # Pricing
+    purchase_price, marlon_margin = product_pricing(old_p)
+
+    # Brand
+    brand_id = None
+    if old_p.get("brand"):
+        brand_id = brand_map.get(name_key(old_p["brand"]))
+
+    # Product type
+    product_type = map_product_type(old_p.get("product_type"))
+
+    # Variant data (filtres IT)
+    variant_data = {}
+    if old_p.get("filter_color"):
+        variant_data["color"] = old_p["filter_color"]
+    if old_p.get("filter_processor"):
+        variant_data["processor"] = old_p["filter_processor"]
+    if old_p.get("filter_storage"):
+        variant_data["storage"] = old_p["filter_storage"]
+    if old_p.get("filter_screenSize"):
+        variant_data["screenSize"] = old_p["filter_screenSize"]
+    if old_p.get("product_family"):
+        variant_data["product_family"] = old_p["product_family"]
+
+    # Référence unique (éviter les doublons), réservée par reserve_references
+    if old_id in reference_map:
+        unique_ref = reference_map[old_id]
+    else:
+        unique_ref = make_unique_reference(old_p.get("serial_number"), old_id)
 
-    # Grouper les variantes
+    return {
+        "name": old_p.get("name") or f"Produit #{old_id}",
+        "reference": unique_ref,
+        "description": old_p.get("description") or None,
+        "purchase_price_ht": purchase_price,
+        "marlon_margin_percent": marlon_margin,
+        "supplier_id": None,
+        "brand_id": brand_id,
+        "default_leaser_id": None,
+        "product_type": product_type,
+        "serial_number": old_p.get("serial_number") or None,
+        "technical_info": old_p.get("technicals_informations") or None,
+        "variant_data": variant_data if variant_data else {},
+        "created_at": old_p.get("created_at"),
+    }
+
+
+def product_pricing(old_p):
+    """(purchase_price_ht, marlon_margin_percent) d'un ancien produit (marge par défaut 30 %)."""
+    pricing = pricing_map.get(old_p.get("pricing")) if old_p.get("pricing") else None
+    marlon_margin = pricing["marlon_margin"] if pricing and pricing.get("marlon_margin") is not None else 30
+    purchase_price = old_p.get("provider_price") or (pricing["provider_price"] if pricing else None) or 0
+    return float(purchase_price), float(marlon_margin)
+
+
+def product_hash(old_p):
+    """Empreinte d'un ancien produit, pricing associé inclus."""
+    pricing = pricing_map.get(old_p.get("pricing")) if old_p.get("pricing") else None
+    return row_hash(old_p, pricing)
+
+
+def build_group_map(old_products):
+    """Regroupe les variantes par product_group_uid."""
     group_map = {}
     for p in old_products:
         gid = p.get("product_group_uid")
         if gid:
             group_map.setdefault(gid, []).append(p)
+    return group_map
 
-    # is_cheapest_in_group d'abord (parents)
-    sorted_products = sorted(old_products, key=lambda p: (
-        not p.get("is_cheapest_in_group", False),
-        p["id"],
-    ))
 
-    for old_p in sorted_products:
-        stats["products_total"] += 1
-        old_id = old_p["id"]
-
-        # Pricing
-        pricing = pricing_map.get(old_p.get("pricing")) if old_p.get("pricing") else None
-        marlon_margin = pricing["marlon_margin"] if pricing and pricing.get("marlon_margin") is not None else 30
-        purchase_price = old_p.get("provider_price") or (pricing["provider_price"] if pricing else None) or 0
-
-        # Brand
-        brand_id = None
-        if old_p.get("brand"):
-            brand_id = brand_map.get(old_p["brand"].strip().lower())
-
-        # Product type
-        product_type = map_product_type(old_p.get("product_type"))
-
-        # Variant data (filtres IT)
-        variant_data = {}
-        if old_p.get("filter_color"):
-            variant_data["color"] = old_p["filter_color"]
-        if old_p.get("filter_processor"):
-            variant_data["processor"] = old_p["filter_processor"]
-        if old_p.get("filter_storage"):
-            variant_data["storage"] = old_p["filter_storage"]
-        if old_p.get("filter_screenSize"):
-            variant_data["screenSize"] = old_p["filter_screenSize"]
-        if old_p.get("product_family"):
-            variant_data["product_family"] = old_p["product_family"]
-
-        # Parent product (variantes groupées)
-        parent_product_id = None
-        gid = old_p.get("product_group_uid")
-        if gid and not old_p.get("is_cheapest_in_group"):
-            group = group_map.get(gid, [])
-            parent = next((g for g in group if g.get("is_cheapest_in_group")), None)
-            if parent and parent["id"] in product_map:
-                parent_product_id = product_map[parent["id"]]
-
-        # Générer une référence unique (éviter les doublons)
-        unique_ref = make_unique_reference(old_p.get("serial_number"), old_id)
+def product_batches(old_products):
+    """Lots d'insertion par id croissant ; l'ordre parents / variantes est indifférent."""
+    yield from chunked(sorted(old_products, key=lambda p: p["id"]), BATCH_SIZE)
+
+
+def shard_products(old_products, shards):
+    """Répartit les produits en `shards` parts ; les variantes d'un groupe restent ensemble."""
+    parts = [[] for _ in range(shards)]
+    for p in old_products:
+        key = p.get("product_group_uid") or f"id:{p['id']}"
+        parts[zlib.crc32(str(key).encode()) % shards].append(p)
+    return [part for part in parts if part]
+
 
-        # Insert produit
+def run_sharded(ctx, old_products, process_batch, after_batch=None):
+    """
+    Applique `process_batch(ctx, lot)` à tous les produits, répartis sur
+    PRODUCT_WORKERS shards exécutés en parallèle, chacun avec son contexte
+    (donc ses clients). `after_batch` (journal, progression) est appelé
+    sous `state_lock` après chaque lot. La première erreur d'un shard est
+    propagée une fois tous les shards arrêtés.
+    """
+    def run_shard(shard_ctx, shard):
+        for batch in product_batches(shard):
+            process_batch(shard_ctx, batch)
+            if after_batch:
+                with state_lock:
+                    after_batch()
+
+    shards = shard_products(old_products, PRODUCT_WORKERS)
+    if len(shards) <= 1:
+        for shard in shards:
+            run_shard(ctx, shard)
+        return
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = [pool.submit(run_shard, ctx.fork(), shard) for shard in shards]
+    for future in futures:
+        future.result()
+
+
+# ============================================================
+# 6a. Variantes : parent_product_id posé en second passage
+# ============================================================
+def resolve_parents(old_products):
+    """
+    Résout les groupes product_group_uid en mémoire, une fois tous les produits
+    insérés. Retourne {nouvel id de variante: nouvel id du parent ou None} et
+    la liste des groupes sans parent (aucun is_cheapest_in_group, ou parent
+    dont l'insertion a échoué) ; leurs variantes restent sans parent.
+    """
+    wanted = {}
+    orphans = []
+    for gid, group in build_group_map(old_products).items():
+        flagged = sorted((p for p in group if p.get("is_cheapest_in_group")), key=lambda p: p["id"])
+        parent = flagged[0] if flagged else None
+        parent_id = product_map.get(parent["id"]) if parent else None
+        if parent_id is None:
+            orphans.append({
+                "group": gid,
+                "reason": "parent non migré" if parent else "aucun is_cheapest_in_group",
+                "products": sorted(p["id"] for p in group),
+            })
+        for p in group:
+            new_id = product_map.get(p["id"])
+            if new_id and new_id != parent_id:
+                wanted[new_id] = parent_id
+    return wanted, orphans
+
+
+def link_variants(ctx, old_products):
+    """
+    Second passage : compare les parents voulus à ceux en base et corrige
+    parent_product_id. Les produits déjà réécrits pendant ce run le sont à
+    nouveau, parent compris, par upsert groupé de BATCH_SIZE lignes ; les
+    autres (inchangés en --incremental, éventuellement retouchés dans le
+    back-office) ne reçoivent qu'une mise à jour du parent, une requête par
+    parent. Les lots partent en parallèle.
+    """
+    print("\n🧬 Liaison des variantes à leur parent...")
+    wanted, orphans = resolve_parents(old_products)
+    current = {
+        r["id"]: r
+        for r in fetch_all_rows(ctx.new_sb, "products", "id, parent_product_id, reference")
+    }
+
+    # Variantes à rattacher (ou à détacher d'un parent disparu)
+    targets = {}
+    for new_id, parent_id in wanted.items():
+        if new_id in current and current[new_id].get("parent_product_id") != parent_id:
+            targets[new_id] = parent_id
+    # Un parent n'a pas lui-même de parent (ex-variante promue parent de son groupe)
+    for new_id in set(p for p in wanted.values() if p):
+        if new_id in current and current[new_id].get("parent_product_id") is not None:
+            targets[new_id] = None
+
+    rows = []
+    by_parent = {}
+    for old_p in sorted(old_products, key=lambda p: p["id"]):
+        new_id = product_map.get(old_p["id"])
+        if new_id not in targets:
+            continue
+        if new_id not in rewritten_products:
+            by_parent.setdefault(targets[new_id], []).append(new_id)
+            continue
+        # Même référence que la ligne écrite plus tôt dans le run
+        reference_map.setdefault(old_p["id"], current[new_id].get("reference"))
+        row = {"id": new_id, **build_product_row(old_p), "parent_product_id": targets[new_id]}
+        row.pop("created_at", None)
+        rows.append(row)
+
+    def upsert(batch):
+        written = sum(1 for r in insert_rows(ctx, "products", batch, upsert=True) if r)
+        count("variants_linked", written)
+        count("variants_failed", len(batch) - written)
+
+    def update(job):
+        parent_id, ids = job
         try:
-            result = new_sb.table("products").insert({
-                "name": old_p.get("name") or f"Produit #{old_id}",
-                "reference": unique_ref,
-                "description": old_p.get("description") or None,
-                "purchase_price_ht": float(purchase_price),
-                "marlon_margin_percent": float(marlon_margin),
-                "supplier_id": None,
-                "brand_id": brand_id,
-                "default_leaser_id": None,
-                "product_type": product_type,
-                "serial_number": old_p.get("serial_number") or None,
-                "technical_info": old_p.get("technicals_informations") or None,
-                "variant_data": variant_data if variant_data else {},
-                "parent_product_id": parent_product_id,
-                "created_at": old_p.get("created_at"),
-            }).execute()
+            with metrics.track("new_db.update") as call:
+                result = (
+                    ctx.new_sb.table("products").update({"parent_product_id": parent_id}).in_("id", ids).execute()
+                )
+                call["rows"] = len(result.data or [])
+            count("variants_linked", len(ids))
         except Exception as e:
-            print(f"  ❌ \"{old_p.get('name')}\" (old #{old_id}) — {e}")
-            stats["products_errors"] += 1
-            continue
+            print(f"  ⚠️  Erreur liaison variantes (parent {parent_id}): {e}")
+            count("variants_failed", len(ids))
 
-        if not result.data:
-            print(f"  ❌ \"{old_p.get('name')}\" (old #{old_id}) — erreur insertion")
-            stats["products_errors"] += 1
-            continue
+    jobs = [(upsert, batch) for batch in chunked(rows, BATCH_SIZE)] + [
+        (update, (parent_id, ids))
+        for parent_id, variant_ids in by_parent.items()
+        for ids in chunked(variant_ids, DELETE_CHUNK)
+    ]
+    if jobs:
+        with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+            list(pool.map(lambda job: job[0](job[1]), jobs))
+
+    orphan_groups[:] = orphans
+    stats["groups_without_parent"] = len(orphans)
+    print(f"  ✅ {stats['variants_linked']} variantes (re)liées, {stats['variants_failed']} en échec, "
+          f"{len(orphans)} groupes sans parent")
+    for orphan in orphans[:10]:
+        print(f"    ⚠️  Groupe {orphan['group']} : {orphan['reason']} (anciens ids {orphan['products'][:5]})")
+    if len(orphans) > 10:
+        print(f"    … {len(orphans) - 10} autres (voir le rapport JSON)")
+
+
+def migrate_products(ctx, old_products, pricing_data, on_batch=None):
+    print("\n📦 Migration des produits...")
+
+    for p in pricing_data:
+        pricing_map[p["id"]] = p
+
+    # En reprise, les produits des lots déjà journalisés sont ignorés
+    remaining = [p for p in old_products if p["id"] not in product_map]
+    if len(remaining) < len(old_products):
+        print(f"  ⏭️  {len(old_products) - len(remaining)} produits déjà migrés (reprise)")
+    total = stats["products_migrated"] + stats["products_errors"] + len(remaining)
+
+    # Fonction pure de la liste complète : identique d'un run ou d'une reprise à l'autre
+    used_references.clear()
+    reserve_references(old_products)
+    adopt_kept_products(ctx, old_products)
+    variant_groups.update(build_group_map(old_products))
+    # Spécialités manquantes créées une fois pour toutes, avant le découpage en shards
+    ensure_specialties(ctx, [name for p in remaining for name in parse_specialties(p.get("speciality"))])
+
+    def after_batch():
+        if on_batch:
+            on_batch()
+        progress("produits", stats["products_migrated"] + stats["products_errors"], total)
+
+    run_sharded(ctx, remaining, migrate_products_batch, after_batch)
+
+    link_variants(ctx, old_products)
+
+
+def adopt_kept_products(ctx, old_products):
+    """
+    Les produits liés à des commandes survivent au nettoyage (et à la bascule
+    --staging) avec leur id d'origine, souvent aléatoire. L'ancien produit de
+    même référence reprend cet id au lieu de son id stable : il est mis à jour
+    en place plutôt que rejeté par la contrainte UNIQUE de products.reference.
+    """
+    kept_product_ids.clear()
+    try:
+        ordered = sorted(set(r["product_id"] for r in fetch_all_rows(ctx.live_sb, "order_items", "product_id")))
+    except Exception:
+        ordered = []
+    kept = {}
+    for batch in chunked(ordered, DELETE_CHUNK):
+        with metrics.track("new_db.select") as call:
+            rows = ctx.live_sb.table("products").select("id, reference").in_("id", batch).execute().data or []
+            call["rows"] = len(rows)
+        kept.update({r["reference"]: r["id"] for r in rows if r.get("reference")})
+    for old_p in old_products:
+        kept_id = kept.get(reference_map.get(old_p["id"]))
+        if kept_id:
+            kept_product_ids[old_p["id"]] = kept_id
+    if kept_product_ids:
+        print(f"  🔗 {len(kept_product_ids)} produits commandés conservés : mis à jour en place")
+
+
+def migrate_products_batch(ctx, batch):
+    """Insère un lot de produits en une requête, puis leurs lignes de jonction en masse."""
+    count("products_total", len(batch))
+
+    # La fonction SQL écrit dans les tables en ligne : pas en mode --staging
+    if LOADER == "rpc" and not ctx.staging:
+        ids = {old_p["id"]: new_product_id(old_p["id"]) for old_p in batch}
+        result = load_products_rpc(ctx, batch, ids)
+        if result is not None:
+            written, failed = result
+            new_ids = [written.get(old_p["id"]) for old_p in batch]
+            record_products(batch, new_ids, "products_migrated", "insertion", failed)
+            return
+
+    rows = [{"id": new_product_id(old_p["id"]), **build_product_row(old_p)} for old_p in batch]
+    new_ids = [r["id"] if r else None for r in insert_rows(ctx, "products", rows, upsert=True)]
+    failed = link_products(ctx, written_products(batch, new_ids))
+    record_products(batch, new_ids, "products_migrated", "insertion", failed)
+
+
+def written_products(batch, new_ids):
+    """Couples (ancien produit, nouvel id) écrits ; `new_ids` est aligné sur `batch` (None = échec)."""
+    return [(old_p, new_id) for old_p, new_id in zip(batch, new_ids) if new_id]
+
+
+def record_products(batch, new_ids, stat, action, failed=()):
+    """
+    Enregistre un lot une fois ses jonctions écrites (mapping, empreinte,
+    stats) : un checkpoint pris par un autre shard pendant l'écriture des
+    liens ne voit pas le lot, une reprise le réécrit en entier. `new_ids`
+    est aligné sur `batch` (None = échec). Les produits dont une image ou
+    une jonction a échoué (nouveaux ids dans `failed`) n'ont pas
+    d'empreinte : le prochain --incremental les voit modifiés et les réécrit.
+    """
+    with state_lock:
+        for old_p, new_id in zip(batch, new_ids):
+            old_id = old_p["id"]
+            if not new_id:
+                print(f"  ❌ \"{old_p.get('name')}\" (old #{old_id}) — erreur {action}")
+                stats["products_errors"] += 1
+                continue
+
+            product_map[old_id] = new_id
+            rewritten_products.add(new_id)
+            if new_id in failed:
+                product_hashes.pop(old_id, None)
+            else:
+                product_hashes[old_id] = product_hash(old_p)
+            stats[stat] += 1
+
+
+def link_products(ctx, linked):
+    """
+    Crée les lignes de jonction (images, catégorie, spécialités) d'un lot
+    de couples (ancien produit, nouvel id), écrites en masse. Retourne les
+    nouveaux ids des produits dont une image ou une jonction a échoué.
+    """
+    image_tasks, category_rows, specialty_rows = build_links(ctx, linked)
+    image_rows, failed = transfer_product_images(ctx, image_tasks)
+
+    # --- Jonctions en masse (ids déterministes : rejouables après reprise) ---
+    failed |= write_links(ctx, "product_images", image_rows, "images_uploaded", "images_failed")
+    failed |= write_links(ctx, "product_categories", category_rows, "category_links", "links_failed")
+    failed |= write_links(ctx, "product_specialties", specialty_rows, "specialties_linked", "links_failed")
+    return failed
+
+
+def write_links(ctx, table, rows, stat, failed_stat):
+    """
+    Écrit des lignes de jonction (upsert) et compte réussites (`stat`) et
+    échecs (`failed_stat`). Retourne les product_id des lignes en échec.
+    """
+    failed = [row for row, result in zip(rows, insert_rows(ctx, table, rows, upsert=True)) if not result]
+    count(stat, len(rows) - len(failed))
+    count(failed_stat, len(failed))
+    return set(row["product_id"] for row in failed)
+
+
+def build_links(ctx, linked):
+    """
+    Prépare les jonctions d'un lot de couples (ancien produit, nouvel id) :
+    retourne (tâches d'images, lignes product_categories, lignes product_specialties).
+    """
+    image_tasks = []
+    category_rows = []
+    specialty_rows = []
 
-        new_product = result.data[0]
-        new_product_id = new_product["id"]
-        product_map[old_id] = new_product_id
-        stats["products_migrated"] += 1
-        print(f"  ✅ \"{old_p.get('name')}\" (old #{old_id}) → {new_product_id[:8]}...")
+    # Spécialités manquantes du lot : une seule insertion groupée
+    ensure_specialties(ctx, [
+        name for old_p, _ in linked for name in parse_specialties(old_p.get("speciality"))
+    ])
 
-        # --- Image : télécharger et uploader sur Storage ---
+    for old_p, new_product_id in linked:
+        # --- Image : transférée en parallèle après la boucle ---
         old_image = old_p.get("image")
         if old_image:
-            storage_url = upload_image_to_storage(
-                old_image,
-                "product-images",
-                f"products/{new_product_id}",
-            )
-            if storage_url:
-                new_sb.table("product_images").insert({
-                    "product_id": new_product_id,
-                    "image_url": storage_url,
-                    "order_index": 0,
-                }).execute()
-                stats["images_uploaded"] += 1
-                print(f"    🖼️  Image uploadée")
-            else:
-                stats["images_failed"] += 1
+            image_tasks.append((new_product_id, old_image, "product-images", f"products/{new_product_id}"))
 
         # --- Lien catégorie ---
         cat_id = old_p.get("category")
         if cat_id and cat_id in category_map:
-            new_sb.table("product_categories").insert({
+            category_rows.append({
+                "id": stable_id("product_category", new_product_id, category_map[cat_id]),
                 "product_id": new_product_id,
                 "category_id": category_map[cat_id],
-            }).execute()
-            stats["category_links"] += 1
+            })
 
         # --- Spécialités du produit ---
-        spec_data = old_p.get("speciality")
-        if spec_data:
-            if isinstance(spec_data, str):
-                try:
-                    spec_data = json.loads(spec_data)
-                except Exception:
-                    spec_data = None
-
-            if spec_data:
-                specs = spec_data if isinstance(spec_data, list) else [spec_data]
-                for spec in specs:
-                    if isinstance(spec, dict):
-                        spec_name = (spec.get("name") or spec.get("label") or "").strip()
-                    else:
-                        spec_name = str(spec).strip()
-                    if not spec_name:
-                        continue
-
-                    match = next((s for s in existing_specs if s["name"].lower() == spec_name.lower()), None)
-
-                    if not match:
-                        res = new_sb.table("specialties").insert({"name": spec_name}).execute()
-                        if res.data:
-                            match = res.data[0]
-                            existing_specs.append(match)
-
-                    if match:
-                        new_sb.table("product_specialties").insert({
-                            "product_id": new_product_id,
-                            "specialty_id": match["id"],
-                        }).execute()
-                        stats["specialties_linked"] += 1
+        linked_specs = set()
+        for spec_name in parse_specialties(old_p.get("speciality")):
+            match = ensure_specialty(ctx, spec_name)
+
+            if match and match["id"] not in linked_specs:
+                linked_specs.add(match["id"])
+                specialty_rows.append({
+                    "id": stable_id("product_specialty", new_product_id, match["id"]),
+                    "product_id": new_product_id,
+                    "specialty_id": match["id"],
+                })
+    return image_tasks, category_rows, specialty_rows
+
+
+def transfer_product_images(ctx, image_tasks):
+    """
+    Téléchargement/upload concurrents ; retourne (lignes product_images
+    réussies, nouveaux ids des produits dont l'image a échoué). Une URL
+    morte ignorée n'est pas un échec : la relancer ne donnerait rien de plus.
+    """
+    image_rows = []
+    failed = set()
+    for new_product_id, storage_url, renditions, skipped in transfer_images(ctx, image_tasks):
+        if storage_url:
+            image_rows.append({
+                "id": stable_id("product_image", new_product_id, 0),
+                "product_id": new_product_id,
+                **image_columns(storage_url, renditions),
+                "order_index": 0,
+            })
+        elif not skipped:
+            count("images_failed")
+            failed.add(new_product_id)
+    return image_rows, failed
+
+
+# ============================================================
+# 6c. Chargement côté serveur : une fonction SQL par lot (MIGRATION_LOADER=rpc)
+# ============================================================
+def parent_candidate(old_p):
+    """Id (déterministe) du parent attendu d'une variante, None pour un parent ou hors groupe."""
+    gid = old_p.get("product_group_uid")
+    if not gid or old_p.get("is_cheapest_in_group"):
+        return None
+    flagged = sorted(p["id"] for p in variant_groups.get(gid, []) if p.get("is_cheapest_in_group"))
+    if not flagged:
+        return None
+    return product_map.get(flagged[0]) or new_product_id(flagged[0])
+
+
+def load_products_rpc(ctx, batch, ids, replace_links=False):
+    """
+    Envoie un lot complet (produits, images déjà transférées, liens catégorie
+    et spécialités, parent attendu) en un seul appel à `migrate_products_batch`,
+    qui écrit tout dans une transaction. Retourne {ancien id: nouvel id}, ou
+    None si l'appel échoue (rien n'a été écrit) ; sinon ({ancien id: nouvel
+    id}, nouveaux ids des produits dont l'image n'a pas pu être transférée).
+    """
+    rows = []
+    for old_p in batch:
+        row = {"old_id": str(old_p["id"]), "id": ids[old_p["id"]], **build_product_row(old_p)}
+        row["parent_id"] = parent_candidate(old_p)
+        rows.append(row)
+    linked = [(old_p, ids[old_p["id"]]) for old_p in batch]
+    image_tasks, category_rows, specialty_rows = build_links(ctx, linked)
+    image_rows, failed = transfer_product_images(ctx, image_tasks)
+    payload = {
+        "replace_links": replace_links,
+        "products": rows,
+        "images": image_rows,
+        "categories": category_rows,
+        "specialties": specialty_rows,
+    }
+    try:
+        with metrics.track("new_db.rpc") as call:
+            result = ctx.new_sb.rpc("migrate_products_batch", {"payload": payload}).execute().data
+            call["rows"] = len(rows) + len(payload["images"]) + len(category_rows) + len(specialty_rows)
+    except Exception as e:
+        print(f"  ⚠️  Lot RPC en échec ({len(batch)} produits), repli PostgREST : {e}")
+        return None
+    count("images_uploaded", result.get("images", 0))
+    count("category_links", result.get("categories", 0))
+    count("specialties_linked", result.get("specialties", 0))
+    written = {_old_key(old_id): new_id for old_id, new_id in (result.get("products") or {}).items()}
+    return written, failed
+
+
+# ============================================================
+# 6b. Synchronisation incrémentale des produits (delta)
+# ============================================================
+def sync_products(ctx, old_products, pricing_data, on_batch=None):
+    """
+    Mode incrémental : insère les nouveaux produits, met à jour les produits
+    modifiés (contenu ou pricing) et supprime ceux disparus de l'ancien projet.
+    Les produits inchangés ne génèrent aucune écriture.
+    """
+    print("\n🔄 Synchronisation incrémentale des produits...")
+
+    for p in pricing_data:
+        pricing_map[p["id"]] = p
+
+    # Oublier les mappings dont la cible n'existe plus dans le nouveau projet
+    current_refs = {r["id"]: r.get("reference") for r in fetch_all_rows(ctx.new_sb, "products", "id, reference")}
+    for old_id, new_id in list(product_map.items()):
+        if new_id not in current_refs:
+            product_map.pop(old_id)
+            product_hashes.pop(old_id, None)
+
+    old_ids = set(p["id"] for p in old_products)
+    to_insert = [p for p in old_products if p["id"] not in product_map]
+    to_update = [
+        p for p in old_products
+        if p["id"] in product_map and product_hashes.get(p["id"]) != product_hash(p)
+    ]
+    to_delete = [old_id for old_id in product_map if old_id not in old_ids]
+    stats["products_unchanged"] = len(old_products) - len(to_insert) - len(to_update)
+    print(f"  🔄 {len(to_insert)} nouveaux, {len(to_update)} modifiés, "
+          f"{len(to_delete)} supprimés, {stats['products_unchanged']} inchangés")
+
+    # Les références des produits non modifiés restent réservées
+    updated_ids = set(product_map[p["id"]] for p in to_update)
+    used_references.update(
+        ref for new_id, ref in current_refs.items() if ref and new_id not in updated_ids
+    )
+
+    delete_products(ctx, to_delete)
+
+    reserve_references(to_update)
+    reserve_references(to_insert)
+    variant_groups.update(build_group_map(old_products))
+    ensure_specialties(ctx, [
+        name for p in to_update + to_insert for name in parse_specialties(p.get("speciality"))
+    ])
+    run_sharded(ctx, to_update, update_products_batch, on_batch)
+    run_sharded(ctx, to_insert, migrate_products_batch, on_batch)
+    print(f"  ✅ {stats['products_updated']} mis à jour, {stats['products_migrated']} insérés")
+
+    link_variants(ctx, old_products)
+
+
+def update_products_batch(ctx, batch):
+    """Met à jour un lot de produits existants (upsert groupé) et régénère leurs jonctions."""
+    if LOADER == "rpc":
+        ids = {old_p["id"]: product_map[old_p["id"]] for old_p in batch}
+        result = load_products_rpc(ctx, batch, ids, replace_links=True)
+        if result is not None:
+            written, failed = result
+            new_ids = [written.get(old_p["id"]) for old_p in batch]
+            record_products(batch, new_ids, "products_updated", "mise à jour", failed)
+            return
+
+    rows = [{"id": product_map[old_p["id"]], **build_product_row(old_p)} for old_p in batch]
+    for row in rows:
+        row.pop("created_at", None)
+    new_ids = [r["id"] if r else None for r in insert_rows(ctx, "products", rows, upsert=True)]
+    linked = written_products(batch, new_ids)
+
+    # Les jonctions sont recréées à partir de l'ancien produit
+    failed = set()
+    for table in ("product_images", "product_categories", "product_specialties"):
+        try:
+            with metrics.track("new_db.delete"):
+                ctx.new_sb.table(table).delete(returning="minimal").in_(
+                    "product_id", [new_id for _, new_id in linked]
+                ).execute()
+        except Exception as e:
+            print(f"  ⚠️  Erreur nettoyage {table}: {e}")
+            failed.update(new_id for _, new_id in linked)
+    failed |= link_products(ctx, linked)
+    record_products(batch, new_ids, "products_updated", "mise à jour", failed)
+
+
+def delete_products(ctx, old_ids):
+    """Supprime les produits disparus (sauf ceux liés à des commandes)."""
+    if not old_ids:
+        return
+    try:
+        referenced = fetch_all_rows(ctx.new_sb, "order_items", "product_id")
+        referenced_ids = set(r["product_id"] for r in referenced)
+    except Exception:
+        referenced_ids = set()
+
+    new_ids = [product_map[old_id] for old_id in old_ids if product_map[old_id] not in referenced_ids]
+    try:
+        stats["products_deleted"] += delete_ids(ctx, "products", new_ids)
+    except Exception as e:
+        print(f"  ⚠️  Erreur suppression produits: {e}")
+    for old_id in old_ids:
+        product_map.pop(old_id, None)
+        product_hashes.pop(old_id, None)
+
+
+# ============================================================
+# 6d. Prix de location précalculés (table product_prices, migration 020)
+# ============================================================
+def load_price_grid(ctx):
+    """
+    Grille des coefficients du nouveau projet : durées {id: mois} et, par
+    (leaser, durée), les tranches triées par montant minimum avec leurs
+    bornes (max None = sans plafond). Retourne aussi l'empreinte de la grille.
+    """
+    durations = {d["id"]: d["months"] for d in fetch_all_rows(ctx.new_sb, "leasing_durations", "id, months")}
+    coefficients = fetch_all_rows(
+        ctx.new_sb, "leaser_coefficients", "leaser_id, duration_id, min_amount, max_amount, coefficient",
+    )
+    grid = {}
+    for c in sorted(coefficients, key=lambda c: float(c["min_amount"])):
+        if c["duration_id"] in durations:
+            grid.setdefault((c["leaser_id"], c["duration_id"]), []).append((
+                float(c["min_amount"]),
+                None if c["max_amount"] is None else float(c["max_amount"]),
+                float(c["coefficient"]),
+            ))
+    return durations, grid, row_hash(sorted(durations.items()), sorted(grid.items()))
+
+
+def price_rows(products, durations, grid):
+    """
+    Lignes product_prices de `products` [(nouvel id, prix de vente)] : pour
+    chaque (leaser, durée), produits triés par prix et tranches parcourues en
+    un seul passage (même formule que /api/products/[id]/price). Si des
+    tranches se chevauchent, la plus haute (montant minimum le plus grand) l'emporte.
+    """
+    by_price = sorted(products, key=lambda p: p[1])
+    rows = []
+    for (leaser_id, duration_id), tranches in grid.items():
+        months = durations[duration_id]
+        i = 0
+        for product_id, selling in by_price:
+            while i + 1 < len(tranches) and tranches[i + 1][0] <= selling:
+                i += 1
+            match = next((
+                t for t in tranches[i::-1]
+                if t[0] <= selling and (t[1] is None or selling <= t[1])
+            ), None)
+            if match is None:
+                continue
+            coefficient = match[2]
+            monthly = selling * coefficient / 100
+            rows.append({
+                "id": stable_id("product_price", product_id, leaser_id, duration_id),
+                "product_id": product_id,
+                "leaser_id": leaser_id,
+                "duration_id": duration_id,
+                "months": months,
+                "coefficient": coefficient,
+                "selling_price": round(selling, 4),
+                "monthly_price": round(monthly, 4),
+                "total_price": round(monthly * months, 4),
+            })
+    return rows
+
+
+def delete_product_prices(ctx, product_ids):
+    """Supprime les prix précalculés de produits dont les prix sont recalculés."""
+    def delete_chunk(chunk):
+        with metrics.track("new_db.delete") as call:
+            ctx.new_sb.table("product_prices").delete(returning="minimal").in_("product_id", chunk).execute()
+            call["rows"] = len(chunk)
+
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        list(pool.map(delete_chunk, list(chunked(product_ids, DELETE_CHUNK))))
+
+
+def migrate_prices(ctx, old_products):
+    """
+    Précalcule les prix de location de chaque produit migré pour toutes les
+    durées et tous les leasers dont une tranche couvre son prix de vente.
+    Seuls les produits dont le prix d'achat, la marge ou la grille de
+    coefficients a changé depuis le dernier calcul sont recalculés.
+    """
+    print("\n💶 Précalcul des prix de location...")
+    durations, grid, grid_hash = load_price_grid(ctx)
+    if not grid:
+        print("  ⚠️  Aucun coefficient leaser : prix non précalculés")
+        return
+
+    for old_id in [k for k in price_hashes if k not in product_map]:
+        price_hashes.pop(old_id)  # produits supprimés : prix effacés en cascade
+
+    changed = {}
+    unchanged = 0
+    for old_p in old_products:
+        new_id = product_map.get(old_p["id"])
+        if not new_id:
+            continue
+        purchase_price, marlon_margin = product_pricing(old_p)
+        digest = row_hash(purchase_price, marlon_margin, grid_hash)
+        if price_hashes.get(old_p["id"]) != digest:
+            changed[old_p["id"]] = (new_id, purchase_price * (1 + marlon_margin / 100), digest)
+        else:
+            unchanged += 1
+
+    stale = [changed[old_id][0] for old_id in changed if old_id in price_hashes]
+    if stale:
+        delete_product_prices(ctx, stale)
+
+    rows = price_rows([(new_id, selling) for new_id, selling, _ in changed.values()], durations, grid)
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        chunks = list(chunked(rows, BATCH_SIZE))
+        written = [r for part in pool.map(lambda c: insert_rows(ctx, "product_prices", c, upsert=True), chunks)
+                   for r in part]
+
+    failed = set(row["product_id"] for row, result in zip(rows, written) if result is None)
+    for old_id, (new_id, _, digest) in changed.items():
+        if new_id not in failed:
+            price_hashes[old_id] = digest
+    stats["products_priced"] += len(changed) - len(failed)
+    stats["prices_written"] += sum(1 for r in written if r)
+    print(f"  ✅ {stats['prices_written']} prix écrits pour {stats['products_priced']} produits "
+          f"({unchanged} inchangés, {len(grid)} grilles leaser × durée)")
+
+
+# ============================================================
+# 7. Plan (--dry-run) : toute la logique de mapping, sans écriture
+# ============================================================
+PLAN_IMAGE_SAMPLE = 200  # images sondées (HEAD) pour estimer le volume à transférer
+
+
+def pages(rows):
+    """Requêtes de lecture keyset pour `rows` lignes (la dernière page est vide ou partielle)."""
+    return rows // PAGE_SIZE + 1
+
+
+def batches(rows, size=None):
+    size = size or BATCH_SIZE
+    return -(-rows // size)
+
+
+def count_rows(ctx, table):
+    """Nombre de lignes d'une table du nouveau projet (0 si la table n'existe pas)."""
+    try:
+        with metrics.track("new_db.select"):
+            return ctx.new_sb.table(table).select("id", count="exact").limit(1).execute().count or 0
+    except Exception:
+        return 0
+
+
+def plan_clean(ctx):
+    """Lignes que le nettoyage du mode complet supprimerait, par table."""
+    tables = [
+        "product_variant_filters_junction", "product_variants", "product_documents", "cart_items",
+        "product_images", "product_specialties", "product_categories",
+        "category_specialties", "category_it_types", "categories", "brands",
+    ]
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        counts = dict(zip(tables, pool.map(lambda t: count_rows(ctx, t), tables)))
+    referenced = set(r["product_id"] for r in fetch_all_rows(ctx.new_sb, "order_items", "product_id"))
+    counts["products"] = max(0, count_rows(ctx, "products") - len(referenced))
+    return counts
+
+
+def probe_image_size(ctx, url):
+    """Taille annoncée (Content-Length) d'une image, None si inconnue."""
+    try:
+        with host_slot(url), metrics.track("image.head"):
+            response = ctx.http.head(url, timeout=10, allow_redirects=True)
+        return int(response.headers.get("Content-Length") or 0) or None
+    except Exception:
+        return None
+
+
+def plan_images(ctx, image_tasks):
+    """
+    Images à transférer : URLs distinctes, déjà présentes dans le cache de
+    déduplication, et volume estimé à partir d'un échantillon sondé en HEAD.
+    `image_tasks` : liste de (bucket, url source).
+    """
+    valid = [(bucket, normalize_image_url(url)) for bucket, url in image_tasks if normalize_image_url(url)]
+    urls = set(valid)
+    cached = 0
+    if DEDUP_IMAGES:
+        # Une URL n'est transférée qu'une fois ; celles du cache ne le sont plus du tout
+        cache = get_image_cache() if os.path.exists(IMAGE_CACHE_PATH) else None
+        to_transfer = []
+        for bucket, url in sorted(urls):
+            if cache and cache.lookup_url(url, ctx.new_url, bucket) and (
+                not RENDITIONS or cache.lookup_renditions(ctx.new_url, bucket, rendition_spec(), url=url) is not None
+            ):
+                cached += 1
+            else:
+                to_transfer.append((bucket, url))
+    else:
+        to_transfer = valid
+
+    sample = random.Random(0).sample(to_transfer, min(PLAN_IMAGE_SAMPLE, len(to_transfer)))
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        sizes = [size for size in pool.map(lambda t: probe_image_size(ctx, t[1]), sample) if size]
+    average = sum(sizes) / len(sizes) if sizes else 0
+    return {
+        "tasks": len(image_tasks),
+        "unique_urls": len(urls),
+        "cached": cached,
+        "to_transfer": len(to_transfer),
+        "probed": len(sample),
+        "probed_known_size": len(sizes),
+        "estimated_bytes": int(average * len(to_transfer)),
+        "renditions_per_image": len(RENDITIONS),
+    }
+
+
+def plan_variants(old_products, written):
+    """
+    Groupes touchés par les produits écrits : variantes à rattacher (upsert
+    groupé par BATCH_SIZE si réécrites pendant le run, sinon une mise à jour
+    du parent par groupe), parents cibles et groupes sans parent.
+    """
+    written_ids = set(p["id"] for p in written)
+    variants = parents = orphans = parent_updates = 0
+    for group in build_group_map(old_products).values():
+        if not any(p["id"] in written_ids for p in group):
+            continue
+        if any(p.get("is_cheapest_in_group") for p in group):
+            parents += 1
+            variants += len(group) - 1
+            if not all(p["id"] in written_ids for p in group):
+                parent_updates += 1
+        else:
+            orphans += 1
+    return {
+        "update": variants, "parents": parents, "groups_without_parent": orphans,
+        "parent_updates": parent_updates,
+    }
+
+
+def plan_migration(ctx, old_data, incremental=False):
+    """
+    Calcule le plan complet d'un run (mode complet ou incrémental) : mêmes
+    règles que les phases réelles (product_type, matching des noms,
+    références uniques, groupes de variantes), aucune écriture distante.
+    """
+    products, pricing, categories = old_data
+    for p in pricing:
+        pricing_map[p["id"]] = p
+    tables = {}
+
+    # --- Catégories ---
+    category_index = {} if not incremental else get_name_index(ctx, "categories", "id, name")
+    named = [c for c in categories if (c.get("name") or "").strip()]
+    if incremental:
+        existing_ids = set(c["id"] for c in category_index.values())
+        valid = {old_id for old_id, new_id in category_map.items() if new_id in existing_ids}
+        old_ids = set(c["id"] for c in categories)
+        removed = [old_id for old_id in valid if old_id not in old_ids]
+        changed = [c for c in named if not (c["id"] in valid and category_hashes.get(c["id"]) == row_hash(c))]
+        deleted = sum(1 for old_id in removed if old_id in category_created)
+    else:
+        changed, deleted = named, 0
+    created = set()
+    for c in changed:
+        key = name_key(c["name"].strip())
+        if key not in category_index:
+            created.add(key)
+    category_types = {}
+    for c in changed:
+        category_types[category_product_type(c)] = category_types.get(category_product_type(c), 0) + 1
+    tables["categories"] = {
+        "create": len(created),
+        "map": len(changed) - len(created),
+        "delete": deleted,
+        "unchanged": len(named) - len(changed),
+        "product_types": category_types,
+    }
+    planned_categories = set(category_map) | set(c["id"] for c in named)
+
+    # --- Marques ---
+    brand_index = {} if not incremental else get_name_index(ctx, "brands")
+    brand_keys = set(name_key(p["brand"]) for p in products if (p.get("brand") or "").strip())
+    tables["brands"] = {
+        "create": sum(1 for k in brand_keys if k not in brand_index),
+        "map": sum(1 for k in brand_keys if k in brand_index),
+    }
+
+    # --- Produits (delta en mode incrémental) ---
+    if incremental:
+        current_refs = {r["id"]: r.get("reference") for r in fetch_all_rows(ctx.new_sb, "products", "id, reference")}
+        mapped = {old_id for old_id, new_id in product_map.items() if new_id in current_refs}
+        old_ids = set(p["id"] for p in products)
+        to_insert = [p for p in products if p["id"] not in mapped]
+        to_update = [p for p in products if p["id"] in mapped and product_hashes.get(p["id"]) != product_hash(p)]
+        to_delete = [old_id for old_id in mapped if old_id not in old_ids]
+        updated_ids = set(product_map[p["id"]] for p in to_update)
+        used_references.update(ref for new_id, ref in current_refs.items() if ref and new_id not in updated_ids)
+    else:
+        to_insert, to_update, to_delete = products, [], []
+    written = to_update + to_insert
+    reserve_references(written)
+    product_types = {}
+    for p in written:
+        t = map_product_type(p.get("product_type"))
+        product_types[t] = product_types.get(t, 0) + 1
+    tables["products"] = {
+        "create": len(to_insert),
+        "update": len(to_update),
+        "delete": len(to_delete),
+        "unchanged": len(products) - len(written),
+        "references_suffixed": sum(
+            1 for p in written
+            if reference_map.get(p["id"]) and reference_map[p["id"]] != (p.get("serial_number") or "").strip()
+        ),
+        "product_types": product_types,
+    }
+    tables["products.parent_product_id"] = plan_variants(products, written)
+
+    # --- Spécialités et jonctions ---
+    spec_index = get_name_index(ctx, "specialties")
+    product_specs = [(p, set(name_key(n) for n in parse_specialties(p.get("speciality")))) for p in written]
+    category_specs = [set(name_key(n) for n in parse_specialties(c.get("speciality"))) for c in changed]
+    spec_keys = set().union(*[k for _, k in product_specs], *category_specs)
+    tables["specialties"] = {
+        "create": sum(1 for k in spec_keys if k not in spec_index),
+        "map": sum(1 for k in spec_keys if k in spec_index),
+    }
+    tables["product_specialties"] = {"create": sum(len(k) for _, k in product_specs)}
+    tables["product_categories"] = {"create": sum(1 for p in written if p.get("category") in planned_categories)}
+    tables["category_specialties"] = {"create": sum(len(k) for k in category_specs)}
+
+    # --- Images ---
+    image_tasks = [("product-images", p.get("image")) for p in written if p.get("image")]
+    image_tasks += [("category-images", c.get("image")) for c in changed if c.get("image")]
+    images = plan_images(ctx, image_tasks)
+    tables["product_images"] = {"create": sum(1 for p in written if normalize_image_url(p.get("image")))}
+
+    plan = {
+        "mode": "incremental" if incremental else "full",
+        "clean": plan_clean(ctx) if not incremental else {},
+        "tables": tables,
+        "images": images,
+    }
+    plan["requests"] = estimate_requests(plan, old_data)
+    return plan
+
+
+def estimate_requests(plan, old_data):
+    """Nombre de requêtes du run planifié, par type d'appel (même découpage que les métriques)."""
+    tables = plan["tables"]
+    products = tables["products"]
+    written = products["create"] + products["update"]
+    write_batches = batches(written)
+    transfers = plan["images"]["to_transfer"]
+    requests = {
+        "old_db.select": sum(pages(len(rows)) for rows in old_data),
+        "new_db.select": 3 + pages(sum(products[k] for k in ("create", "update", "unchanged"))) + 1,
+        "new_db.delete": len(plan["clean"]) + batches(products["delete"], DELETE_CHUNK) + 3 * batches(products["update"]),
+        "new_db.insert": (
+            tables["categories"]["create"] + tables["brands"]["create"]
+            + batches(tables["specialties"]["create"]) + batches(tables["category_specialties"]["create"])
+        ),
+        "new_db.upsert": (
+            batches(tables["categories"]["map"])
+            + (0 if LOADER == "rpc" else 4 * write_batches + batches(tables["products.parent_product_id"]["update"]))
+        ),
+        "new_db.update": tables["products.parent_product_id"]["parent_updates"],
+        "new_db.rpc": write_batches if LOADER == "rpc" else 0,
+        "image.download": transfers,
+        "storage.upload": transfers * (1 + plan["images"]["renditions_per_image"]),
+    }
+    requests["total"] = sum(requests.values())
+    return requests
+
+
+def print_plan(plan):
+    print("\n═══════════════════════════════════════════════════")
+    print(f"🗺️  PLAN DE MIGRATION ({'incrémental' if plan['mode'] == 'incremental' else 'complet'}, aucune écriture)")
+    print("═══════════════════════════════════════════════════")
+    if plan["clean"]:
+        print(f"  🧹 Nettoyage     : {sum(plan['clean'].values())} lignes supprimées")
+    for table, actions in plan["tables"].items():
+        counts = ", ".join(f"{k} {v}" for k, v in actions.items() if not isinstance(v, dict))
+        print(f"  {table:<27} {counts}")
+    images = plan["images"]
+    print(f"  🖼️  Images        : {images['to_transfer']} à transférer / {images['unique_urls']} URLs distinctes "
+          f"({images['cached']} en cache), ~{images['estimated_bytes'] / 1e6:.1f} Mo estimés")
+    print(f"  📡 Requêtes      : ~{plan['requests']['total']} au total")
+    for kind, n in plan["requests"].items():
+        if kind != "total":
+            print(f"     {kind:<22} ~{n}")
+    print(f"  📝 Plan écrit dans {PLAN_PATH}")
+    print("═══════════════════════════════════════════════════")
+
+
+def dry_run(ctx, incremental):
+    """Exécute le mode --dry-run : lecture seule, plan affiché et écrit en JSON."""
+    if incremental and load_state() is None:
+        print(f"\n❌ ERREUR : aucun état trouvé ({STATE_PATH}), lancer d'abord une migration complète.")
+        return None
+    old_data = timed_phase(fetch_old_data, ctx)
+    with metrics.phase("plan_migration"):
+        plan = plan_migration(ctx, old_data, incremental)
+    with open(PLAN_PATH, "w", encoding="utf-8") as f:
+        json.dump(plan, f, indent=2, ensure_ascii=False)
+    print_plan(plan)
+    return plan
 
 
 # ============================================================
 # MAIN
 # ============================================================
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Migration des produits : ancien → nouveau Supabase")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="synchronise uniquement le delta sans vider le catalogue",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="reprend un run interrompu depuis le dernier checkpoint",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="calcule et affiche le plan de migration sans rien écrire",
+    )
+    parser.add_argument(
+        "--staging",
+        action="store_true",
+        help="charge le catalogue dans les tables fantômes puis le bascule en une transaction",
+    )
+    return parser.parse_args(argv)
+
+
+def timed_phase(func, *args):
+    """Exécute une phase non journalisée en la mesurant."""
+    with metrics.phase(func.__name__):
+        return func(*args)
+
+
+def run_phase(name, checkpoint, func, *args, **kwargs):
+    """Exécute une phase sauf si le journal la marque terminée, puis journalise."""
+    if name in phases_done:
+        print(f"\n⏭️  Phase {name} déjà terminée (reprise)")
+        return
+    with metrics.phase(func.__name__):
+        func(*args, **kwargs)
+    phases_done.append(name)
+    checkpoint()
+
+
+def main(argv=None, ctx=None):
+    args = parse_args(argv)
+    ctx = ctx or MigrationContext.from_env()
+
     print("🚀 ═══════════════════════════════════════════════════")
     print("   MIGRATION PRODUITS : Ancien → Nouveau Supabase")
     print("   (avec upload des images sur Supabase Storage)")
     print("═══════════════════════════════════════════════════════")
 
-    if "XXXXXXXX" in OLD_SUPABASE_URL:
-        print("\n❌ ERREUR : Renseigner les variables dans migration/.env !")
-        return
-    if "REMPLACER" in NEW_SUPABASE_SERVICE_KEY:
-        print("\n❌ ERREUR : Renseigner NEW_SUPABASE_SERVICE_KEY dans migration/.env !")
+    error = ctx.config_error() or rendition_config_error()
+    if error:
+        print(f"\n❌ ERREUR : {error}")
         return
 
     # Réinitialiser l'état pour permettre des relances propres
     reset_state()
 
-    products, pricing, categories = fetch_old_data()
-    clean_existing_data()
-    migrate_categories(categories)
-    migrate_brands(products)
-    migrate_products(products, pricing)
+    if args.dry_run:
+        return dry_run(ctx, args.incremental)
+
+    incremental = args.incremental
+    staging = args.staging
+    if args.resume:
+        checkpoint = load_checkpoint()
+        if checkpoint is None:
+            print(f"\n❌ ERREUR : aucun checkpoint trouvé ({CHECKPOINT_PATH}).")
+            return
+        incremental = checkpoint["incremental"]
+        staging = checkpoint["staging"]
+        print(f"\n♻️  Reprise du run {'incrémental' if incremental else 'complet'} "
+              f"({len(product_map)} produits déjà migrés, phases : {', '.join(phases_done) or 'aucune'})")
+    elif incremental and staging:
+        print("\n❌ ERREUR : --staging s'applique à une migration complète, pas à --incremental.")
+        return
+    elif incremental and load_state() is None:
+        print(f"\n❌ ERREUR : aucun état trouvé ({STATE_PATH}), lancer d'abord une migration complète.")
+        return
+    ctx.staging = staging
+
+    def checkpoint():
+        save_checkpoint(incremental, staging)
+
+    # L'extraction tourne en arrière-plan pendant le nettoyage du nouveau projet
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        old_data = prefetch.submit(timed_phase, fetch_old_data, ctx)
+        if staging:
+            run_phase("clean", checkpoint, reset_staging, ctx)
+        elif not incremental:
+            run_phase("clean", checkpoint, clean_existing_data, ctx)
+        products, pricing, categories = old_data.result()
+    if PREFLIGHT:
+        timed_phase(preflight_images, ctx, products, categories)
+
+    if incremental:
+        run_phase("categories", checkpoint, migrate_categories, ctx, categories, incremental=True)
+        run_phase("brands", checkpoint, migrate_brands, ctx, products)
+        run_phase("products", checkpoint, sync_products, ctx, products, pricing, on_batch=checkpoint)
+    else:
+        run_phase("categories", checkpoint, migrate_categories, ctx, categories)
+        run_phase("brands", checkpoint, migrate_brands, ctx, products)
+        run_phase("products", checkpoint, migrate_products, ctx, products, pricing, on_batch=checkpoint)
+    if staging:
+        run_phase("swap", checkpoint, swap_staging, ctx)
+    run_phase("prices", checkpoint, migrate_prices, ctx, products)
+    if STORAGE_GC:
+        run_phase("storage_gc", checkpoint, collect_storage_garbage, ctx)
+    shutdown_rendition_pool()
+    save_state()
+    if os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+    report = write_report()
 
     print("\n═══════════════════════════════════════════════════")
     print("📊 RÉSUMÉ DE LA MIGRATION")
     print("═══════════════════════════════════════════════════")
     print(f"  📦 Produits     : {stats['products_migrated']}/{stats['products_total']} migrés ({stats['products_errors']} erreurs)")
+    if incremental:
+        print(f"  🔄 Delta        : {stats['products_updated']} mis à jour, {stats['products_deleted']} supprimés, "
+              f"{stats['products_unchanged']} inchangés")
     print(f"  📂 Catégories   : {stats['categories_created']} créées, {stats['categories_mapped']} mappées")
     print(f"  🏷️  Marques      : {stats['brands_created']} créées, {stats['brands_mapped']} mappées")
-    print(f"  🖼️  Images       : {stats['images_uploaded']} uploadées, {stats['images_failed']} échouées")
+    print(f"  🖼️  Images       : {stats['images_uploaded']} uploadées, {stats['images_failed']} échouées, "
+          f"{stats['images_skipped']} URLs mortes ignorées, {stats['images_reused']} réutilisées")
+    if STORAGE_GC:
+        print(f"  🗑️  Storage      : {stats['storage_orphans_removed']} orphelins supprimés, "
+              f"{stats['storage_objects_kept']} objets conservés")
+    print(f"  ↻  Relances     : {stats['http_retries']} (téléchargements / uploads)")
     print(f"  🔗 Liens catég. : {stats['category_links']} créés")
     print(f"  🏥 Spécialités  : {stats['specialties_linked']} liées")
+    if stats["links_failed"]:
+        print(f"  ⚠️  Jonctions   : {stats['links_failed']} lignes catégorie / spécialité en échec")
+    print(f"  🧬 Variantes    : {stats['variants_linked']} liées, {stats['variants_failed']} en échec, "
+          f"{stats['groups_without_parent']} groupes sans parent")
+    print(f"  💶 Prix         : {stats['prices_written']} précalculés ({stats['products_priced']} produits)")
+    print(f"  ⏱️  Durée        : {report['duration_s']:.0f} s (rapport : {REPORT_PATH})")
+    memory = report["memory"]
+    if "peak_mb" in memory:
+        heaviest = max(report["phases"].items(), key=lambda item: item[1].get("peak_mb", 0))
+        print(f"  🧠 Mémoire      : pic RSS {memory['peak_rss_mb']} Mo ; tracée : pic {memory['peak_mb']:.1f} Mo "
+              f"({heaviest[0]} : {heaviest[1].get('peak_mb', 0):.1f} Mo), {memory['current_mb']:.1f} Mo en fin de run")
+    elif memory["peak_rss_mb"] is not None:
+        print(f"  🧠 Mémoire      : pic RSS {memory['peak_rss_mb']} Mo (détail : MIGRATION_MEMORY_REPORT=1)")
+    for kind, call in report["calls"].items():
+        print(f"     {kind:<22} {call['count']:>6} appels, p50 {call['p50_ms']:.0f} ms, "
+              f"p95 {call['p95_ms']:.0f} ms, {call['bytes'] / 1e6:.1f} Mo")
     print("═══════════════════════════════════════════════════")
     print("✅ Migration terminée !")
 
@@ -0,0 +1,6 @@
+-- Resized / re-encoded image variants generated by the catalog migration
+-- (migration/migrate.py, MIGRATION_RENDITIONS). Shape:
+--   {"thumb": {"url": "...", "width": 200, "height": 150}, "card": {...}, "full": {...}}
+-- NULL when only the original image_url is available.
+ALTER TABLE product_images ADD COLUMN IF NOT EXISTS renditions JSONB;
+ALTER TABLE categories ADD COLUMN IF NOT EXISTS renditions JSONB;
@@ -0,0 +1,110 @@
+-- Set-based loader for the catalog migration (migration/migrate.py, MIGRATION_LOADER=rpc).
+-- One call writes a whole batch of products with their images, category and
+-- specialty links in a single transaction, and returns the old id -> new id map.
+--
+-- payload:
+-- {
+--   "replace_links": false,           -- true: drop the batch's existing images / links first
+--   "products":   [{"old_id": "42", "id": "<uuid>", "name": ..., "parent_id": "<uuid>|null", ...}],
+--   "images":     [{"id", "product_id", "image_url", "order_index", "renditions"}],
+--   "categories": [{"id", "product_id", "category_id"}],
+--   "specialties":[{"id", "product_id", "specialty_id"}]
+-- }
+-- Columns are typed from the target tables themselves (jsonb_populate_record[set]).
+CREATE OR REPLACE FUNCTION migrate_products_batch(payload JSONB)
+RETURNS JSONB AS $$
+DECLARE
+  id_map JSONB;
+  images_count INTEGER;
+  categories_count INTEGER;
+  specialties_count INTEGER;
+  parents_count INTEGER;
+BEGIN
+  -- Products (upsert on the deterministic id; created_at is kept on update)
+  WITH incoming AS (
+    SELECT p.*, src.value->>'old_id' AS old_id
+    FROM jsonb_array_elements(payload->'products') AS src(value),
+         jsonb_populate_record(NULL::products, src.value) AS p
+  ),
+  written AS (
+    INSERT INTO products (
+      id, name, reference, description, purchase_price_ht, marlon_margin_percent,
+      supplier_id, brand_id, default_leaser_id, product_type, serial_number,
+      technical_info, variant_data, created_at
+    )
+    SELECT
+      id, name, reference, description, purchase_price_ht, marlon_margin_percent,
+      supplier_id, brand_id, default_leaser_id, product_type, serial_number,
+      technical_info, COALESCE(variant_data, '{}'::jsonb), COALESCE(created_at, NOW())
+    FROM incoming
+    ON CONFLICT (id) DO UPDATE SET
+      name = EXCLUDED.name,
+      reference = EXCLUDED.reference,
+      description = EXCLUDED.description,
+      purchase_price_ht = EXCLUDED.purchase_price_ht,
+      marlon_margin_percent = EXCLUDED.marlon_margin_percent,
+      supplier_id = EXCLUDED.supplier_id,
+      brand_id = EXCLUDED.brand_id,
+      default_leaser_id = EXCLUDED.default_leaser_id,
+      product_type = EXCLUDED.product_type,
+      serial_number = EXCLUDED.serial_number,
+      technical_info = EXCLUDED.technical_info,
+      variant_data = EXCLUDED.variant_data
+    RETURNING id
+  )
+  SELECT COALESCE(jsonb_object_agg(incoming.old_id, written.id), '{}'::jsonb)
+  INTO id_map
+  FROM incoming JOIN written ON written.id = incoming.id;
+
+  -- Junctions are rebuilt from scratch for updated products
+  IF COALESCE((payload->>'replace_links')::boolean, false) THEN
+    DELETE FROM product_images WHERE product_id IN (SELECT (value #>> '{}')::uuid FROM jsonb_each(id_map));
+    DELETE FROM product_categories WHERE product_id IN (SELECT (value #>> '{}')::uuid FROM jsonb_each(id_map));
+    DELETE FROM product_specialties WHERE product_id IN (SELECT (value #>> '{}')::uuid FROM jsonb_each(id_map));
+  END IF;
+
+  INSERT INTO product_images (id, product_id, image_url, order_index, renditions)
+  SELECT id, product_id, image_url, COALESCE(order_index, 0), renditions
+  FROM jsonb_populate_recordset(NULL::product_images, COALESCE(payload->'images', '[]'::jsonb))
+  ON CONFLICT (id) DO UPDATE SET
+    image_url = EXCLUDED.image_url,
+    order_index = EXCLUDED.order_index,
+    renditions = EXCLUDED.renditions;
+  GET DIAGNOSTICS images_count = ROW_COUNT;
+
+  INSERT INTO product_categories (id, product_id, category_id)
+  SELECT id, product_id, category_id
+  FROM jsonb_populate_recordset(NULL::product_categories, COALESCE(payload->'categories', '[]'::jsonb))
+  ON CONFLICT DO NOTHING;
+  GET DIAGNOSTICS categories_count = ROW_COUNT;
+
+  INSERT INTO product_specialties (id, product_id, specialty_id)
+  SELECT id, product_id, specialty_id
+  FROM jsonb_populate_recordset(NULL::product_specialties, COALESCE(payload->'specialties', '[]'::jsonb))
+  ON CONFLICT DO NOTHING;
+  GET DIAGNOSTICS specialties_count = ROW_COUNT;
+
+  -- Variants whose parent already exists (same batch or an earlier one);
+  -- the others are linked by the migration's final variant pass
+  UPDATE products AS p
+  SET parent_product_id = c.parent_id
+  FROM jsonb_to_recordset(payload->'products') AS c(id UUID, parent_id UUID)
+  WHERE p.id = c.id
+    AND c.parent_id IS NOT NULL
+    AND p.parent_product_id IS DISTINCT FROM c.parent_id
+    AND EXISTS (SELECT 1 FROM products parent WHERE parent.id = c.parent_id);
+  GET DIAGNOSTICS parents_count = ROW_COUNT;
+
+  RETURN jsonb_build_object(
+    'products', id_map,
+    'images', images_count,
+    'categories', categories_count,
+    'specialties', specialties_count,
+    'parents', parents_count
+  );
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the service role (used by the migration script) may bulk-load the catalog
+REVOKE EXECUTE ON FUNCTION migrate_products_batch(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION migrate_products_batch(JSONB) TO service_role;
@@ -0,0 +1,157 @@
+-- Shadow copies of the catalog tables for the staged full migration
+-- (migration/migrate.py --staging). The migration loads everything into
+-- staging_* while the storefront keeps reading the live tables, then
+-- swap_catalog_staging() replaces the live catalog in one transaction.
+--
+-- The shadow tables copy columns, defaults, checks and unique indexes of the
+-- live tables, but no foreign keys, triggers or RLS policies: the load order
+-- is free and every insert is cheaper. Columns added later to a live table
+-- must be added to its staging_ copy as well.
+CREATE TABLE IF NOT EXISTS staging_brands (LIKE brands INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_categories (LIKE categories INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_category_specialties (LIKE category_specialties INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_products (LIKE products INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_product_images (LIKE product_images INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_product_categories (LIKE product_categories INCLUDING ALL);
+CREATE TABLE IF NOT EXISTS staging_product_specialties (LIKE product_specialties INCLUDING ALL);
+
+-- Not part of the public API: RLS on without policies, and no grants for
+-- anon / authenticated (the service role bypasses RLS)
+DO $$
+DECLARE
+  t TEXT;
+BEGIN
+  FOREACH t IN ARRAY ARRAY[
+    'staging_brands', 'staging_categories', 'staging_category_specialties', 'staging_products',
+    'staging_product_images', 'staging_product_categories', 'staging_product_specialties'
+  ] LOOP
+    EXECUTE format('ALTER TABLE %I ENABLE ROW LEVEL SECURITY', t);
+    EXECUTE format('REVOKE ALL ON %I FROM anon, authenticated', t);
+  END LOOP;
+END $$;
+
+-- Empties the shadow tables before a new load
+CREATE OR REPLACE FUNCTION reset_catalog_staging()
+RETURNS VOID AS $$
+BEGIN
+  TRUNCATE staging_brands, staging_categories, staging_category_specialties, staging_products,
+    staging_product_images, staging_product_categories, staging_product_specialties;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Copies one shadow table into its live table (upsert on id, created_at kept).
+-- The column list is read from the shadow table; `filter` is a condition on
+-- its rows, aliased `s`.
+CREATE OR REPLACE FUNCTION copy_catalog_staging_table(live_table TEXT, filter TEXT DEFAULT 'TRUE')
+RETURNS BIGINT AS $$
+DECLARE
+  cols TEXT;
+  updates TEXT;
+  copied BIGINT;
+BEGIN
+  SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position),
+         string_agg(format('%1$I = EXCLUDED.%1$I', column_name), ', ' ORDER BY ordinal_position)
+           FILTER (WHERE column_name NOT IN ('id', 'created_at'))
+  INTO cols, updates
+  FROM information_schema.columns
+  WHERE table_schema = 'public' AND table_name = 'staging_' || live_table;
+
+  EXECUTE format(
+    'INSERT INTO %1$I (%2$s) SELECT %2$s FROM %3$I s WHERE %4$s ON CONFLICT (id) DO UPDATE SET %5$s',
+    live_table, cols, 'staging_' || live_table, filter, updates
+  );
+  GET DIAGNOSTICS copied = ROW_COUNT;
+  RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Replaces the live catalog with the shadow tables, in a single transaction:
+-- readers keep seeing the previous catalog until the commit, then the new one.
+--
+-- expected: {"brands": n, "categories": n, "products": n}, the row counts the
+-- migration wrote; any mismatch (or an empty staging_products) aborts the swap
+-- and leaves the live catalog untouched.
+--
+-- As the non-staged cleanup does, products referenced by order_items are kept
+-- (and updated in place when re-migrated), together with their brands. The
+-- migration loads the staged copy of a kept product under the kept id (matched
+-- on reference), so the upsert on id never trips the UNIQUE reference.
+-- The shadow tables are left as is, so the swap can be replayed.
+CREATE OR REPLACE FUNCTION swap_catalog_staging(expected JSONB)
+RETURNS JSONB AS $$
+DECLARE
+  t TEXT;
+  n BIGINT;
+  copied JSONB := '{}'::jsonb;
+BEGIN
+  -- 1. Validation
+  FOREACH t IN ARRAY ARRAY['brands', 'categories', 'products'] LOOP
+    EXECUTE format('SELECT count(*) FROM %I', 'staging_' || t) INTO n;
+    IF expected ? t AND n <> (expected->>t)::BIGINT THEN
+      RAISE EXCEPTION 'staging_% has % rows, expected %', t, n, expected->>t;
+    END IF;
+  END LOOP;
+  IF NOT EXISTS (SELECT 1 FROM staging_products) THEN
+    RAISE EXCEPTION 'staging_products is empty, refusing to swap';
+  END IF;
+
+  -- Catalog writers wait for the swap; readers are not blocked
+  LOCK TABLE brands, categories, category_specialties, products,
+    product_images, product_categories, product_specialties IN SHARE ROW EXCLUSIVE MODE;
+
+  -- 2. Rows depending on the old catalog (children first, optional tables skipped)
+  FOREACH t IN ARRAY ARRAY[
+    'product_variant_filters_junction', 'product_variants', 'product_documents', 'cart_items',
+    'product_images', 'product_specialties', 'product_categories',
+    'category_specialties', 'category_it_types'
+  ] LOOP
+    IF to_regclass('public.' || t) IS NOT NULL THEN
+      EXECUTE format('DELETE FROM %I', t);
+    END IF;
+  END LOOP;
+
+  -- 3. Old catalog, except ordered products and the brands they use
+  UPDATE products SET parent_product_id = NULL WHERE parent_product_id IS NOT NULL;
+  DELETE FROM products p
+  WHERE NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.product_id = p.id)
+    AND NOT EXISTS (SELECT 1 FROM staging_products s WHERE s.id = p.id);
+  DELETE FROM categories c
+  WHERE NOT EXISTS (SELECT 1 FROM staging_categories s WHERE s.id = c.id);
+  DELETE FROM brands b
+  WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.brand_id = b.id)
+    AND NOT EXISTS (SELECT 1 FROM staging_brands s WHERE s.id = b.id);
+
+  -- A kept brand wins over the staged brand of the same name
+  UPDATE staging_products sp
+  SET brand_id = b.id
+  FROM staging_brands sb
+  JOIN brands b ON b.name = sb.name AND b.id <> sb.id
+  WHERE sp.brand_id = sb.id;
+
+  -- 4. New catalog (parents before children)
+  copied := jsonb_build_object('brands', copy_catalog_staging_table(
+    'brands', 'NOT EXISTS (SELECT 1 FROM brands b WHERE b.name = s.name AND b.id <> s.id)'
+  ));
+  FOREACH t IN ARRAY ARRAY[
+    'categories', 'category_specialties', 'products',
+    'product_images', 'product_categories', 'product_specialties'
+  ] LOOP
+    copied := copied || jsonb_build_object(t, copy_catalog_staging_table(t));
+  END LOOP;
+
+  -- Brands left unused by the kept products once they were re-migrated
+  DELETE FROM brands b
+  WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.brand_id = b.id)
+    AND NOT EXISTS (SELECT 1 FROM staging_brands s WHERE s.id = b.id);
+
+  RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only the service role (used by the migration script) may touch the staging area
+REVOKE EXECUTE ON FUNCTION reset_catalog_staging() FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION copy_catalog_staging_table(TEXT, TEXT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION swap_catalog_staging(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION reset_catalog_staging() TO service_role;
+GRANT EXECUTE ON FUNCTION copy_catalog_staging_table(TEXT, TEXT) TO service_role;
+GRANT EXECUTE ON FUNCTION swap_catalog_staging(JSONB) TO service_role;
@@ -0,0 +1,60 @@
+-- Precomputed leasing prices, one row per product x leaser x leasing duration
+-- whose coefficient range contains the product's selling price. Written by
+-- the catalog migration (migration/migrate.py, "prices" phase) with the same
+-- formulas as /api/products/[id]/price:
+--   selling_price = purchase_price_ht * (1 + marlon_margin_percent / 100)
+--   monthly_price = selling_price * coefficient / 100
+--   total_price   = monthly_price * months
+CREATE TABLE IF NOT EXISTS product_prices (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  product_id UUID NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+  leaser_id UUID NOT NULL REFERENCES leasers(id) ON DELETE CASCADE,
+  duration_id UUID NOT NULL REFERENCES leasing_durations(id) ON DELETE CASCADE,
+  months INTEGER NOT NULL,
+  coefficient DECIMAL(10, 4) NOT NULL,
+  selling_price DECIMAL(12, 4) NOT NULL,
+  monthly_price DECIMAL(12, 4) NOT NULL,
+  total_price DECIMAL(14, 4) NOT NULL,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+  UNIQUE(product_id, leaser_id, duration_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_prices_product_months ON product_prices(product_id, months);
+
+ALTER TABLE product_prices ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Public can view product_prices"
+  ON product_prices FOR SELECT
+  TO public
+  USING (true);
+
+-- Prices edited outside the migration invalidate the precomputed rows, and the
+-- price route falls back to computing them. The migration only tracks changes
+-- in the old project's data, so it does not recompute rows deleted by a
+-- back-office edit of products: that product stays on the fallback until its
+-- old-project price changes. A leaser_coefficients change is picked up by the
+-- next migration run, which recomputes the whole grid.
+CREATE OR REPLACE FUNCTION invalidate_product_prices()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_TABLE_NAME = 'products' THEN
+    DELETE FROM product_prices WHERE product_id = NEW.id;
+  ELSE
+    -- NEW is NULL on DELETE and OLD on INSERT
+    DELETE FROM product_prices WHERE leaser_id IN (NEW.leaser_id, OLD.leaser_id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER invalidate_product_prices_on_price_change
+  AFTER UPDATE OF purchase_price_ht, marlon_margin_percent ON products
+  FOR EACH ROW
+  WHEN (OLD.purchase_price_ht IS DISTINCT FROM NEW.purchase_price_ht
+     OR OLD.marlon_margin_percent IS DISTINCT FROM NEW.marlon_margin_percent)
+  EXECUTE FUNCTION invalidate_product_prices();
+
+CREATE TRIGGER invalidate_product_prices_on_coefficient_change
+  AFTER INSERT OR UPDATE OR DELETE ON leaser_coefficients
+  FOR EACH ROW
+  EXECUTE FUNCTION invalidate_product_prices();